@@ -2,6 +2,8 @@ import logging
 import os
 from datetime import datetime
 
+from dateutil.relativedelta import relativedelta
+import numpy as np
 import pandas as pd
 import redcap
 import dax
@@ -38,6 +40,12 @@ ASSR_RENAME = {
     'proc:genprocdata/validation/date': 'QCDATE',
     'proc:genprocdata/validation/validated_by': 'QCBY'}
 
+# Windows of activity we can show, the cache has all the activity sorted by
+# time so any window is found by a binary search without querying again
+ACTIVITY_WINDOWS = ['thisweek', 'lastmonth', 'ytd', 'ALL']
+
+DEFAULT_WINDOW = 'lastmonth'
+
 
 # This is where we save our cache of the data
 def get_filename():
@@ -50,13 +58,44 @@ def get_filename():
     return filename
 
 
-def load_activity_redcap():
-    LABELFIELDS = ['PROJECT', 'SUBJECT', 'SESSION', 'SCAN', 'EVENT', 'FIELD']
+# This is where we keep the activity synced from redcap
+def get_redcap_filename():
+    datadir = 'DATA'
+    if not os.path.isdir(datadir):
+        os.mkdir(datadir)
+
+    filename = f'{datadir}/activityredcap.pkl'
+    return filename
+
+
+def build_label(df, fields):
+    # Join the non-null values of the fields with commas, one column at a
+    # time instead of one row at a time
+    label = np.full(len(df), '', dtype=object)
+    for c in fields:
+        values = df[c].to_numpy()
+        has = pd.notna(values)
+        sep = np.where(label[has] == '', '', ',')
+        label[has] = label[has] + sep + values[has].astype(str)
+
+    return pd.Series(label, index=df.index)
+
 
+def empty_activity():
+    # Activity with no rows, what we use when redcap has nothing for us
     df = pd.DataFrame(columns=[
         'ID', 'LABEL', 'PROJECT', 'SUBJECT', 'SESSION', 'EVENT', 'FIELD',
         'CATEGORY', 'STATUS', 'SOURCE', 'DESCRIPTION', 'DATETIME'
     ])
+    df['DATETIME'] = pd.to_datetime(df['DATETIME'])
+    return df
+
+
+def load_activity_redcap(startdate=None):
+    # Export activity from main redcap, only since startdate if given
+    LABELFIELDS = ['PROJECT', 'SUBJECT', 'SESSION', 'SCAN', 'EVENT', 'FIELD']
+
+    df = empty_activity()
 
     try:
         keyfile = shared.KEYFILE
@@ -65,17 +104,33 @@ def load_activity_redcap():
         k = utils.get_projectkey(i, keyfile)
         mainrc = redcap.Project(shared.API_URL, k)
 
-        logging.info('exporting activity records')
-        df = mainrc.export_records(
+        # Let redcap filter by date so we only get the activity we show
+        filter_logic = None
+        if startdate is not None:
+            filter_logic = "[activity_datetime] >= '{}'".format(
+                startdate.strftime('%Y-%m-%d'))
+
+        logging.info(f'exporting activity records:{filter_logic}')
+        dfr = mainrc.export_records(
             forms=['main', 'activity'],
+            filter_logic=filter_logic,
             format_type='df')
-        df = df[df['redcap_repeat_instrument'] == 'activity']
+
+        # Nothing in the window comes back with no columns
+        if dfr.empty or 'redcap_repeat_instrument' not in dfr:
+            logging.info('no activity records')
+            return df
+
+        dfr = dfr[dfr['redcap_repeat_instrument'] == 'activity'].copy()
+        if dfr.empty:
+            logging.info('no activity records')
+            return df
 
         logging.debug('transforming records')
 
-        df['PROJECT'] = df.index
+        dfr['PROJECT'] = dfr.index
 
-        df.rename(inplace=True, columns={
+        dfr = dfr.rename(columns={
             'redcap_repeat_instance': 'ID',
             'activity_description': 'DESCRIPTION',
             'activity_datetime': 'DATETIME',
@@ -87,17 +142,110 @@ def load_activity_redcap():
             'activity_session': 'SESSION',
             'activity_type': 'CATEGORY',
         })
-        df['SOURCE'] = 'ccmutils'
-        df['STATUS'] = 'COMPLETE'
-        df['LABEL'] = df[LABELFIELDS].apply(
-            lambda x: ','.join(x[x.notnull()]), axis=1)
-        df['DESCRIPTION'] = df['CATEGORY'] + ':' + df['LABEL']
+        dfr['SOURCE'] = 'ccmutils'
+        dfr['STATUS'] = 'COMPLETE'
+        dfr['LABEL'] = build_label(dfr, LABELFIELDS)
+        dfr['DESCRIPTION'] = dfr['CATEGORY'] + ':' + dfr['LABEL']
+        dfr['DATETIME'] = pd.to_datetime(dfr['DATETIME'], errors='coerce')
+
+        # Only replace the empty activity once it all worked
+        df = dfr
     except Exception as err:
         logging.error(f'failed to load activity:{err}')
 
     return df
 
 
+def sync_activity_redcap():
+    # Update our store of redcap activity by exporting only the activity
+    # since the newest we have, then drop activity older than we keep. The
+    # store has the data and the highest repeat instance seen per project.
+    filename = get_redcap_filename()
+    startdate = get_history_start()
+
+    store = {'data': None, 'instances': {}}
+    if os.path.exists(filename):
+        logging.debug(f'reading activity store:{filename}')
+        store = pd.read_pickle(filename)
+
+    dfs = store['data']
+    if dfs is None or dfs.empty:
+        logging.info('loading all activity from redcap')
+        df = load_activity_redcap(startdate=startdate)
+    else:
+        # Get anything on or after the day of the newest, then drop the
+        # instances we already have
+        newest = dfs['DATETIME'].max()
+        since = startdate if pd.isna(newest) else max(newest, startdate)
+        logging.info(f'loading activity from redcap since:{since}')
+        dfn = load_activity_redcap(startdate=since)
+        seen = dfn['PROJECT'].map(store['instances']).fillna(0)
+        dfn = dfn[dfn['ID'] > seen]
+        logging.info(f'loaded {len(dfn)} new activity records')
+        df = pd.concat([dfs, dfn])
+
+    # Remember the highest instance even when we drop it below
+    instances = dict(store['instances'])
+    for k, v in df.groupby('PROJECT')['ID'].max().items():
+        instances[k] = max(v, instances.get(k, 0))
+
+    # Drop anything older than we keep
+    df = df[df['DATETIME'] >= pd.Timestamp(startdate)]
+
+    pd.to_pickle({'data': df, 'instances': instances}, filename)
+
+    return df
+
+
+def get_window_start(window):
+    # Returns the first datetime in the window, None for all time
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if window == 'thisweek':
+        # Monday of this week
+        return today - relativedelta(days=today.weekday())
+    elif window == 'lastmonth':
+        # Past month
+        return today - relativedelta(months=1)
+    elif window == 'ytd':
+        # First day of this year
+        return today.replace(month=1, day=1)
+
+    return None
+
+
+def get_history_start():
+    # The start of the widest window other than all time, this is as far
+    # back as we export activity from redcap
+    return min(get_window_start(x) for x in ACTIVITY_WINDOWS if x != 'ALL')
+
+
+def select_window(df, window=DEFAULT_WINDOW):
+    # df must be sorted by DATETIME as saved by get_data(), returns the
+    # activity in the window newest first with ID numbered from 0
+    startdate = get_window_start(window)
+    if startdate is not None and not df.empty:
+        # Search only the rows with a time, rows without one are last
+        _undated = df['DATETIME'].isna()
+        _dated = df[~_undated]
+        pos = _dated['DATETIME'].searchsorted(pd.Timestamp(startdate))
+
+        # Include anything with job running no matter when it started
+        _older = pd.concat([df[_undated], _dated.iloc[:pos]])
+        _running = _older[
+            (_older['SOURCE'] == 'dax') & (_older['STATUS'] == 'NPUT')]
+        df = pd.concat([_running, _dated.iloc[pos:]])
+    elif not df.empty:
+        # Rows without a time are the oldest
+        _undated = df['DATETIME'].isna()
+        df = pd.concat([df[_undated], df[~_undated]])
+
+    df = df.iloc[::-1].reset_index(drop=True)
+    df['ID'] = df.index
+
+    return df
+
+
 def get_data(xnat, proj_filter):
     df = pd.DataFrame()
     dfc = pd.DataFrame()
@@ -105,36 +253,24 @@ def get_data(xnat, proj_filter):
     dfq = pd.DataFrame()
     dfj = pd.DataFrame()
 
-    # This week: monday of this week
-    # import datetime
-    # today = datetime.date.today()
-    # startdate = today - datetime.timedelta(days=today.weekday())
-
-    # This month: first date of current month
-    # startdate = datetime.datetime.today().replace(day=1)
-
-    # Past month
-    from dateutil.relativedelta import relativedelta
-    startdate = datetime.today() - relativedelta(months=1)
-    startdate = startdate.strftime('%Y-%m-%d')
-
-    dfc = load_activity_redcap()
+    dfc = sync_activity_redcap()
 
     # Load qa data
-    logging.info('loading recent data from xnat')
+    logging.info('loading activity data from xnat')
     dfx = load_xnat_data(xnat, proj_filter)
 
-    dfq = load_recent_qa(dfx, startdate=startdate)
+    dfq, dfj = load_xnat_activity(dfx)
+    del dfx
     logging.info('loaded {} qa records'.format(len(dfq)))
-
-    dfj = load_recent_jobs(dfx, startdate=startdate)
     logging.info('loaded {} job records'.format(len(dfj)))
 
-    # Concatentate all the dataframes into one
+    # Concatentate all the dataframes into one sorted by time, rows without
+    # a time go last so the times stay in order for select_window()
     df = pd.concat([dfi, dfc, dfq, dfj], ignore_index=True)
-    df.sort_values(by=['DATETIME'], inplace=True, ascending=False)
-    df.reset_index(inplace=True)
-    df['ID'] = df.index
+    df['DATETIME'] = pd.to_datetime(df['DATETIME'], errors='coerce')
+    df.sort_values(
+        by=['DATETIME'], inplace=True, kind='stable', na_position='last')
+    df.reset_index(drop=True, inplace=True)
 
     return df
 
@@ -159,52 +295,45 @@ def load_xnat_data(xnat, project_filter):
     return df
 
 
-def load_recent_qa(df, startdate):
-    df = df.copy()
-
-    df['LABEL'] = df['ASSR']
-    df['CATEGORY'] = df['PROCTYPE']
-
-    # Filter by qc date
-    df = df[df['QCDATE'] >= startdate]
-
-    df['STATUS'] = df['QCSTATUS'].map({
-        'Failed': 'FAIL',
-        'Passed': 'PASS'}).fillna('UNKNOWN')
-
-    df['SOURCE'] = 'qa'
-
-    df['CATEGORY'] = df['PROCTYPE']
-
-    df['DESCRIPTION'] = 'QA' + ':' + df['LABEL']
-
-    df['DATETIME'] = df['QCDATE']
-
-    return df
-
-
-def load_recent_jobs(df, startdate):
-    df = df.copy()
-    df['LABEL'] = df['ASSR']
-    df['CATEGORY'] = df['PROCTYPE']
+def load_xnat_activity(df):
+    # Returns the qa and job activity from one pass over the xnat assessors.
+    # Rows are selected by masks first, the new columns are only made for
+    # the selected rows so we never copy the whole frame.
 
-    # Filter by jobstartdate date, include anything with job running
-    df = df[(df['JOBDATE'] >= startdate) | (df['PROCSTATUS'] == 'JOB_RUNNING')]
+    # Parse the dates once
+    qcdate = pd.to_datetime(df['QCDATE'], errors='coerce')
+    jobdate = pd.to_datetime(df['JOBDATE'], errors='coerce')
 
-    df['STATUS'] = df['PROCSTATUS'].map({
-        'COMPLETE': 'COMPLETE',
-        'JOB_FAILED': 'FAIL',
-        'JOB_RUNNING': 'NPUT'}).fillna('UNKNOWN')
+    # Anything that has been qc'd
+    is_qa = qcdate.notna()
 
-    df['SOURCE'] = 'dax'
+    # Anything that has started, include anything with job running
+    is_job = jobdate.notna() | (df['PROCSTATUS'] == 'JOB_RUNNING')
 
-    df['CATEGORY'] = df['PROCTYPE']
+    dfq = df[is_qa]
+    dfq = dfq.assign(
+        LABEL=dfq['ASSR'],
+        CATEGORY=dfq['PROCTYPE'],
+        STATUS=dfq['QCSTATUS'].map({
+            'Failed': 'FAIL',
+            'Passed': 'PASS'}).fillna('UNKNOWN'),
+        SOURCE='qa',
+        DESCRIPTION='QA' + ':' + dfq['ASSR'],
+        DATETIME=qcdate[is_qa])
 
-    df['DESCRIPTION'] = 'JOB' + ':' + df['LABEL']
+    dfj = df[is_job]
+    dfj = dfj.assign(
+        LABEL=dfj['ASSR'],
+        CATEGORY=dfj['PROCTYPE'],
+        STATUS=dfj['PROCSTATUS'].map({
+            'COMPLETE': 'COMPLETE',
+            'JOB_FAILED': 'FAIL',
+            'JOB_RUNNING': 'NPUT'}).fillna('UNKNOWN'),
+        SOURCE='dax',
+        DESCRIPTION='JOB' + ':' + dfj['ASSR'],
+        DATETIME=jobdate[is_job])
 
-    df['DATETIME'] = df['JOBDATE']
-
-    return df
+    return dfq, dfj
 
 
 def run_refresh(filename):
@@ -248,14 +377,16 @@ def load_source_options():
     return load_field_options('SOURCE')
 
 
-def load_data(refresh=False):
+def load_data(refresh=False, window=DEFAULT_WINDOW):
     filename = get_filename()
 
     if refresh or not os.path.exists(filename):
         run_refresh(filename)
 
     logging.info('reading data from file:{}'.format(filename))
-    return utils.read_data(filename)
+    df = utils.read_data(filename)
+
+    return select_window(df, window)
 
 
 def filter_data(df, projects, categories, sources):
@@ -77,6 +77,7 @@ def get_content():
 
     # Get the rows and colums for the table
     activity_columns = [{"name": i, "id": i} for i in ACTIVITY_SHOW_COLS]
+    df = format_datetime(df)
     df.reset_index(inplace=True)
     activity_data = df.to_dict('records')
 
@@ -88,6 +89,15 @@ def get_content():
                 children=activity_graph_content,
                 vertical=True))]),
         html.Button('Refresh Data', id='button-activity-refresh'),
+        dcc.Dropdown(
+            id='dropdown-activity-time',
+            options=[
+                {'label': 'this week', 'value': 'thisweek'},
+                {'label': 'past month', 'value': 'lastmonth'},
+                {'label': 'year to date', 'value': 'ytd'},
+                {'label': 'all time', 'value': 'ALL'}],
+            value=data.DEFAULT_WINDOW,
+            clearable=False),
         dcc.Dropdown(
             id='dropdown-activity-project', multi=True,
             placeholder='Select Projects'),
@@ -138,8 +148,15 @@ def get_content():
     return activity_content
 
 
-def load_activity(refresh=False):
-    return data.load_data(refresh=refresh)
+def load_activity(refresh=False, window=data.DEFAULT_WINDOW):
+    return data.load_data(refresh=refresh, window=window)
+
+
+def format_datetime(df):
+    # Times are datetime64 in the data, show them as text in the table
+    df = df.copy()
+    df['DATETIME'] = df['DATETIME'].dt.strftime('%Y-%m-%d %H:%M').fillna('')
+    return df
 
 
 def load_category_options():
@@ -177,11 +194,13 @@ def was_triggered(callback_ctx, button_id):
     [Input('dropdown-activity-category', 'value'),
      Input('dropdown-activity-project', 'value'),
      Input('dropdown-activity-source', 'value'),
+     Input('dropdown-activity-time', 'value'),
      Input('button-activity-refresh', 'n_clicks')])
 def update_activity(
     selected_category,
     selected_project,
     selected_source,
+    selected_time,
     n_clicks
 ):
     refresh = False
@@ -196,7 +215,8 @@ def update_activity(
         refresh = True
 
     logging.debug('loading activity data')
-    df = load_activity(refresh=refresh)
+    df = load_activity(
+        refresh=refresh, window=selected_time or data.DEFAULT_WINDOW)
 
     # Update lists of possible options for dropdowns (could have changed)
     # make these lists before we filter what to display
@@ -216,7 +236,7 @@ def update_activity(
     # Get the table data
     selected_cols = ['ID', 'DATETIME', 'DESCRIPTION']
     columns = utils.make_columns(selected_cols)
-    records = df.reset_index().to_dict('records')
+    records = format_datetime(df).reset_index().to_dict('records')
 
     # Return table, figure, dropdown options
     logging.debug('update_activity:returning data')
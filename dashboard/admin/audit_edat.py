@@ -1,5 +1,7 @@
 import logging
 
+from .secondary import SecondaryIndex
+
 
 def audit(
     project,
@@ -8,6 +10,7 @@ def audit(
     tab_field,
     ready_field,
     use_secondary=False,
+    secondary_ids=None
 ):
     results = []
 
@@ -17,13 +20,16 @@ def audit(
 
     if use_secondary:
         # Handle secondary ID
-        sec_field = project.export_project_info()['secondary_unique_field']
-        if not sec_field:
+        if secondary_ids is None:
+            index = SecondaryIndex(project)
+        else:
+            index = secondary_ids.get(project)
+
+        if not index.sec_field:
             logging.error('secondary enabled, but no secondary field found')
             return
 
-        rec = project.export_records(fields=[def_field, sec_field])
-        id2subj = {x[def_field]: x[sec_field] for x in rec if x[sec_field]}
+        id2subj = index.id2subj
 
     # Get mri records
     rec = project.export_records(fields=fields, events=events)
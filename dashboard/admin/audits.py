@@ -1,8 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import wait, FIRST_COMPLETED
 from datetime import datetime
 import logging
+import os
+import time
 
+import pandas as pd
 
 import utils
+from .snapshot import MainSnapshot
+from .xnat_cache import SessionCache
+
+
+# How many projects we audit at once
+AUDIT_WORKERS = 4
+
+# Longest we wait for the audit of one project, in seconds
+AUDIT_TIMEOUT = 1800
+
+# Longest we wait for all the projects from when they are submitted, in
+# seconds. Hung audits keep their worker, so projects still queued when
+# this passes are cancelled.
+AUDIT_RUN_TIMEOUT = 7200
+
+# How often we check for audits that timed out, in seconds
+AUDIT_POLL = 10
+
+DURATION_COLUMNS = ['PROJECT', 'STATUS', 'SECONDS', 'ISSUES']
+
+# How many delete requests we send to redcap at once
+DELETE_WORKERS = 4
+
+# Most records we delete in one request
+DELETE_BATCH_SIZE = 100
 
 
 def audit_imaging(
@@ -13,7 +43,9 @@ def audit_imaging(
     src_project_name,
     dst_project_name,
     event2sess,
-    use_secondary=False
+    use_secondary=False,
+    sessions=None,
+    secondary_ids=None
 ):
 
     from .audit_imaging import audit
@@ -27,7 +59,9 @@ def audit_imaging(
         src_project_name,
         dst_project_name,
         use_secondary=use_secondary,
-        event2sess=event2sess)
+        event2sess=event2sess,
+        sessions=sessions,
+        secondary_ids=secondary_ids)
 
 
 def audit_edat(
@@ -36,7 +70,8 @@ def audit_edat(
     raw_field,
     tab_field,
     ready_field,
-    use_secondary=False
+    use_secondary=False,
+    secondary_ids=None
 ):
 
     from .audit_edat import audit
@@ -47,10 +82,13 @@ def audit_edat(
         raw_field,
         tab_field,
         ready_field,
-        use_secondary=use_secondary)
+        use_secondary=use_secondary,
+        secondary_ids=secondary_ids)
 
 
-def audit_project(primaryrc, proj_maindata, maindata):
+def audit_project(
+    primaryrc, proj_maindata, maindata, sessions=None, secondary_ids=None
+):
     issues = []
     event2sess = {}
     proj_name = proj_maindata['main_name']
@@ -77,7 +115,8 @@ def audit_project(primaryrc, proj_maindata, maindata):
             rec['edat_rawfield'],
             rec['edat_convfield'],
             rec['edat_readyfield'],
-            use_secondary=use_secondary)
+            use_secondary=use_secondary,
+            secondary_ids=secondary_ids)
 
     # Scanning
     for rec in scan_data:
@@ -110,7 +149,9 @@ def audit_project(primaryrc, proj_maindata, maindata):
             rec['scanning_srcproject'],
             proj_name,
             event2sess,
-            use_secondary=use_secondary)
+            use_secondary=use_secondary,
+            sessions=sessions,
+            secondary_ids=secondary_ids)
 
     # Ensure project is set
     for i in issues:
@@ -119,7 +160,7 @@ def audit_project(primaryrc, proj_maindata, maindata):
     return issues
 
 
-def audit_root(maindata, project_filter=None):
+def audit_root(maindata, project_filter=None, sessions=None):
     issues = []
     pimap = []
     pi2main = {}
@@ -177,7 +218,10 @@ def audit_root(maindata, project_filter=None):
     try:
         params = {'pimap': pimap}
         logging.info('get unmatched sessions')
-        unmatched = utils.get_unmatched(params)
+        if sessions is None:
+            sessions = SessionCache()
+
+        unmatched = utils.get_unmatched(params, sessions)
         logging.info(f'unmatched count={len(unmatched)}')
 
         for u in sorted(unmatched):
@@ -211,76 +255,208 @@ def audit_root(maindata, project_filter=None):
     return issues
 
 
-def run_audits(mainrc, project_filter=None, function_filter=None):
-    issues = []
-    maindata = mainrc.export_records()
+def get_durations_filename():
+    datadir = 'DATA'
+    if not os.path.isdir(datadir):
+        os.mkdir(datadir)
 
-    # Get list of projects
-    proj_list = sorted(list(set([x['main_name'] for x in maindata])))
+    return f'{datadir}/auditdurations.pkl'
 
-    # Now iterate each project
-    for p in proj_list:
-        if project_filter and p != project_filter:
-            logging.debug(f'skipping project {p}')
-            continue
 
-        logging.info(f'auditing project:{p}')
+def load_durations():
+    # Returns the durations of the projects in the last audit run
+    filename = get_durations_filename()
+    if not os.path.exists(filename):
+        return pd.DataFrame(columns=DURATION_COLUMNS)
+
+    return pd.read_pickle(filename)
+
+
+def save_durations(durations):
+    df = pd.DataFrame(durations, columns=DURATION_COLUMNS)
+    df.sort_values('PROJECT').to_pickle(get_durations_filename())
+
 
+def audit_one_project(p, snapshot, started, sessions=None):
+    # Audit a project, errors are returned as issues so one project can't
+    # stop the others
+    started[p] = time.time()
+
+    try:
         # Get main data for project
-        proj_maindata = {}
-        for rec in maindata:
-            if rec['main_name'] == p and rec['redcap_repeat_instrument'] == '':
-                proj_maindata = rec
+        proj_maindata = snapshot.project_record(p)
 
         # Connect to the primary redcap for this project
         primaryid = proj_maindata['project_primary']
         if not primaryid:
             logging.info(f'no primary id found for project:{p}')
-            continue
+            return [], 'SKIPPED'
 
         primaryrc = utils.get_redcapbyid(primaryid)
         if not primaryrc:
             logging.info(f'no key for project:{p}')
-            continue
+            return [], 'SKIPPED'
+
+        logging.info(f'auditing project:{p}')
+        issues = audit_project(
+            primaryrc,
+            proj_maindata,
+            snapshot.records,
+            sessions=sessions,
+            secondary_ids=snapshot.secondary_ids)
+        return issues, 'COMPLETE'
+    except Exception as err:
+        msg = f'error auditing project:{p}:{err}'
+        logging.error(msg)
+        import traceback
+        traceback.print_exc()
+        return [{'type': 'ERROR', 'project': p, 'description': msg}], 'ERROR'
+
+
+def audit_projects(proj_list, snapshot, sessions=None):
+    # Audit the projects in parallel, a project that takes longer than the
+    # timeout gets an error issue and we stop waiting for it. When the run
+    # takes longer than the run timeout, every project not done yet gets an
+    # error issue, including those that never started. Returns the issues for
+    # each project.
+    results = {}
+    durations = []
+    started = {}
+    executor = ThreadPoolExecutor(max_workers=AUDIT_WORKERS)
+    submitted = time.time()
+    deadline = submitted + AUDIT_RUN_TIMEOUT
+    futures = {executor.submit(
+        audit_one_project, p, snapshot, started, sessions): p
+        for p in proj_list}
+    pending = set(futures.keys())
+
+    while pending:
+        _poll = min(AUDIT_POLL, max(deadline - time.time(), 0))
+        done, pending = wait(
+            pending, timeout=_poll, return_when=FIRST_COMPLETED)
+
+        for f in done:
+            p = futures[f]
+            results[p], status = f.result()
+            durations.append((
+                p, status, time.time() - started[p], len(results[p])))
+
+        now = time.time()
+        for f in list(pending):
+            p = futures[f]
+            if now >= deadline:
+                # Stop it from starting if it hasn't yet
+                f.cancel()
+                msg = f'audit run timed out after {AUDIT_RUN_TIMEOUT} secs:{p}'
+            elif p in started and (now - started[p]) > AUDIT_TIMEOUT:
+                msg = f'audit timed out after {AUDIT_TIMEOUT} secs:{p}'
+            else:
+                continue
 
-        try:
-            issues += audit_project(primaryrc, proj_maindata, maindata)
-        except Exception as err:
-            msg = f'error auditing project:{p}:{err}'
             logging.error(msg)
-            issues.append({
+            results[p] = [{
                 'type': 'ERROR',
                 'project': p,
-                'description': msg
-            })
-            import traceback
-            traceback.print_exc()
+                'description': msg}]
+            _secs = now - started.get(p, submitted)
+            durations.append((p, 'TIMEOUT', _secs, 1))
+            pending.remove(f)
+
+    # Don't wait for any that timed out
+    executor.shutdown(wait=False)
+
+    save_durations(durations)
+
+    return results
+
+
+def run_audits(
+    mainrc, project_filter=None, function_filter=None, snapshot=None
+):
+    issues = []
+    if snapshot is None:
+        snapshot = MainSnapshot(mainrc)
+
+    maindata = snapshot.records
+
+    # Get list of projects
+    proj_list = []
+    for p in snapshot.project_names():
+        if project_filter and p != project_filter:
+            logging.debug(f'skipping project {p}')
+            continue
+
+        proj_list.append(p)
+
+    # XNAT listings for the run, each project is listed once
+    sessions = SessionCache()
+
+    results = audit_projects(proj_list, snapshot, sessions)
+
+    # Merge the issues in project order
+    for p in proj_list:
+        issues += results[p]
 
     # Find UMATCHED_SESSION and other issues not project-specific
-    issues += audit_root(maindata, project_filter=project_filter)
+    issues += audit_root(
+        maindata, project_filter=project_filter, sessions=sessions)
 
     return issues
 
 
-def matching_issues(issue1, issue2):
-    # Matching means both issues are of the same Type
-    # on the same Project/Subject
-    # and as applicable, the same XNAT Session/Scan
-    # and as applicable the same REDCap Event/Field
-    keys = [
-        'main_name', 'issue_type', 'issue_subject',
-        'issue_session', 'issue_scan', 'issue_event', 'issue_field']
+# Matching means both issues are of the same Type
+# on the same Project/Subject
+# and as applicable, the same XNAT Session/Scan
+# and as applicable the same REDCap Event/Field
+ISSUE_KEYS = [
+    'main_name', 'issue_type', 'issue_subject',
+    'issue_session', 'issue_scan', 'issue_event', 'issue_field']
+
 
-    for k in keys:
-        if (k in issue1) and (issue1[k] != issue2[k]):
-            return False
+def issue_signature(issue):
+    # Keys the new issue has, any key it doesn't have matches anything
+    return tuple(k for k in ISSUE_KEYS if k in issue)
 
-    return True
 
+def issue_key(issue, signature):
+    return tuple(issue[k] for k in signature)
+
+
+def reconcile_issues(records, cur):
+    # Returns the records that don't match a current issue and the current
+    # issues that don't match a record. For each signature of the records,
+    # the current issues are indexed by their values for those keys so every
+    # record is found with one lookup instead of comparing every pair.
+    signatures = {}
+    for j, r in enumerate(records):
+        sig = issue_signature(r)
+        signatures.setdefault(sig, []).append(j)
+
+    isnew = [True] * len(records)
+    isold = [True] * len(cur)
+    for sig, _records in signatures.items():
+        index = {}
+        for i, c in enumerate(cur):
+            index.setdefault(issue_key(c, sig), []).append(i)
+
+        for j in _records:
+            matches = index.get(issue_key(records[j], sig), [])
+            if matches:
+                isnew[j] = False
+                for i in matches:
+                    isold[i] = False
+
+    new_issues = [r for r, x in zip(records, isnew) if x]
+    old_issues = [c for c, x in zip(cur, isold) if x]
+
+    return new_issues, old_issues
+
+
+def delete_old_issues(project, project_filter=None, days=7, records=None):
+    # Load the currently completed issues data, unless we already have it
+    if records is None:
+        records = project.export_records(forms=['main', 'issues'])
 
-def delete_old_issues(project, project_filter=None, days=7):
-    # Load the currently completed issues data
-    records = project.export_records(forms=['main', 'issues'])
     records = [x for x in records if x['redcap_repeat_instrument'] == 'issues']
     records = [x for x in records if str(x['issues_complete']) == '2']
 
@@ -288,6 +464,9 @@ def delete_old_issues(project, project_filter=None, days=7):
         # Filter by project so we don't affect other projects
         records = [x for x in records if x['main_name'] == project_filter]
 
+    # Redcap deletes one repeat instance from a list of records in a request,
+    # so group the records by instance
+    batches = {}
     for r in records:
         # Find how many days old the record is
         record_date = r['issue_closedate']
@@ -300,27 +479,47 @@ def delete_old_issues(project, project_filter=None, days=7):
 
         # Delete if more than requested days
         if days_old >= days:
-            _main = r['main_name'],
+            _main = r['main_name']
             _id = r['redcap_repeat_instance']
             logging.debug(f'deleting:issues:{_main}:{_id}:{days_old} days old')
-            # https://redcap.vanderbilt.edu/api/help/?content=del_records
+            batches.setdefault(_id, []).append(_main)
+
+    calls = []
+    for _id, _mains in batches.items():
+        for i in range(0, len(_mains), DELETE_BATCH_SIZE):
+            calls.append((_id, _mains[i:i + DELETE_BATCH_SIZE]))
+
+    logging.info(f'deleting old issues with {len(calls)} requests')
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        futures = [executor.submit(
+            delete_issues, project, _id, _mains) for _id, _mains in calls]
+
+        for f in as_completed(futures):
             try:
-                _payload = {
-                    'action': 'delete',
-                    'returnFormat': 'json',
-                    'records[0]': _main,
-                    'instrument': 'issues',
-                    'repeat_instance': _id,
-                    'content': 'record',
-                    'token': project.token,
-                    'format': 'json'}
-
-                project._call_api(_payload, 'del_record')
+                f.result()
             except Exception as err:
                 logging.error(f'failed to delete records:{err}')
 
 
-def update_issues(records, project, project_filter=None):
+def delete_issues(project, repeat_instance, main_names):
+    # Delete the issue with repeat instance from each main record
+    # https://redcap.vanderbilt.edu/api/help/?content=del_records
+    _payload = {
+        'action': 'delete',
+        'returnFormat': 'json',
+        'instrument': 'issues',
+        'repeat_instance': repeat_instance,
+        'content': 'record',
+        'token': project.token,
+        'format': 'json'}
+
+    for i, _main in enumerate(main_names):
+        _payload[f'records[{i}]'] = _main
+
+    return project._call_api(_payload, 'del_record')
+
+
+def update_issues(records, project, project_filter=None, snapshot=None):
     new_issues = []
     old_issues = []
     has_errors = False
@@ -356,29 +555,22 @@ def update_issues(records, project, project_filter=None):
             'issue_date',
             datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
-    # Load the current existing issues data
-    cur = project.export_records(forms=['main', 'issues'])
-    cur = [x for x in cur if x['redcap_repeat_instrument'] == 'issues']
+    # Load the current existing issues data, we keep the export to find
+    # the completed issues to delete
+    if snapshot is None:
+        snapshot = MainSnapshot(project)
+
+    exported = snapshot.records
+    cur = [x for x in exported if x['redcap_repeat_instrument'] == 'issues']
     cur = [x for x in cur if str(x['issues_complete']) != '2']
 
     if project_filter:
         # Filter by project so we don't affect other projects
         cur = [x for x in cur if x['main_name'] == project_filter]
 
-    # Find new issues
-    for r in records:
-        isnew = True
-        for c in cur:
-            # Try to find a matching record
-            if matching_issues(r, c):
-                isnew = False
-                _id = c['redcap_repeat_instance']
-                _proj = c['main_name']
-                logging.debug(f'matches existing issue:{_proj}:{_id}')
-                break
-
-        if isnew:
-            new_issues.append(r)
+    # Find new issues and the existing issues no longer found
+    new_issues, closed = reconcile_issues(records, cur)
+    logging.debug(f'{len(records) - len(new_issues)} match existing issues')
 
     # Upload new records
     if new_issues:
@@ -393,31 +585,19 @@ def update_issues(records, project, project_filter=None):
         logging.info('no new issues to upload')
 
     # Find old issues
-    logging.debug('checking for old issues')
-    print(len(cur))
-    for c in cur:
-        isold = True
-        # Try to find a matching record
-        for r in records:
-            if matching_issues(r, c):
-                isold = False
-                _id = c['redcap_repeat_instance']
-                _proj = c['main_name']
-                logging.debug(f'matches existing issue:{_proj}:{_id}')
-                break
-
-        if isold:
-            # Append to list as closed with current time
-            _proj = c['main_name']
-            _id = c['redcap_repeat_instance']
-            logging.debug(f'found old issue:{_proj}:{_id}')
-            old_issues.append({
-                'main_name': _proj,
-                'redcap_repeat_instrument': c['redcap_repeat_instrument'],
-                'redcap_repeat_instance': _id,
-                'issues_complete': 2,
-                'issue_closedate': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
+    logging.debug(f'checking {len(cur)} existing issues for old issues')
+    for c in closed:
+        # Append to list as closed with current time
+        _proj = c['main_name']
+        _id = c['redcap_repeat_instance']
+        logging.debug(f'found old issue:{_proj}:{_id}')
+        old_issues.append({
+            'main_name': _proj,
+            'redcap_repeat_instrument': c['redcap_repeat_instrument'],
+            'redcap_repeat_instance': _id,
+            'issues_complete': 2,
+            'issue_closedate': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
 
     # Handle old issues
     if has_errors:
@@ -433,7 +613,7 @@ def update_issues(records, project, project_filter=None):
             logging.error(f'failed to set issues to complete:{err}')
 
         # Delete old completed issues
-        delete_old_issues(project, project_filter)
+        delete_old_issues(project, project_filter, records=exported)
 
     else:
         logging.info('no old issues to complete')
@@ -1,7 +1,7 @@
 import logging
 import re
 import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta
 import shutil
 
 import redcap
@@ -12,15 +12,35 @@ import activity.data as activity_data
 import utils
 import shared
 from .progress_report import make_project_report
+from .snapshot import MainSnapshot
 
 
 SESSCOLUMNS = ['SESSION', 'PROJECT', 'DATE', 'SESSTYPE', 'SITE', 'MODALITY']
 
+# Reports use cached stats that are newer than this, older are exported again
+STATS_MAX_AGE = timedelta(days=1)
 
-def get_projects():
+
+def get_main_snapshot():
+    # Export main redcap once for all the admin tasks in a run
+    try:
+        logging.info('connecting to redcap')
+        i = utils.get_projectid("main", shared.KEYFILE)
+        k = utils.get_projectkey(i, shared.KEYFILE)
+        mainrc = redcap.Project(shared.API_URL, k)
+        return MainSnapshot(mainrc)
+    except Exception as err:
+        logging.error(f'failed to connect to main redcap:{err}')
+        return None
+
+
+def get_projects(snapshot=None):
     logging.info('get_projects')
     projects = []
 
+    if snapshot is not None:
+        return snapshot.project_names()
+
     # Get list of projects from main redcap
     try:
         logging.info('connecting to redcap')
@@ -57,9 +77,9 @@ def load_activity_info(project):
     return df
 
 
-def load_stats(project, stattypes):
-    # Load that data
-    df = stats_data.load_data([project], stattypes, refresh=True)
+def load_stats(project, stattypes, max_age=STATS_MAX_AGE):
+    # Load that data, using the cache when it's fresh enough
+    df = stats_data.load_cached_data([project], stattypes, max_age=max_age)
     if df.empty:
         return df
 
@@ -110,38 +130,32 @@ def load_assrqa_info(project, assrtypes):
     return dfp
 
 
-def update_double_reports(project_filter):
+def update_double_reports(project_filter, snapshot=None):
     from .dataentry_compare import update_reports
 
     # Get list of projects from main redcap
-    try:
-        logging.info('connecting to redcap')
-        i = utils.get_projectid("main", shared.KEYFILE)
-        k = utils.get_projectkey(i, shared.KEYFILE)
-        mainrc = redcap.Project(shared.API_URL, k)
-    except Exception as err:
-        logging.error(f'failed to connect to main redcap:{err}')
-        return
+    if snapshot is None:
+        snapshot = get_main_snapshot()
+        if snapshot is None:
+            return
 
-    update_reports(mainrc, shared.KEYFILE, project_filter)
+    update_reports(
+        snapshot.mainrc, shared.KEYFILE, project_filter, snapshot=snapshot)
 
 
-def update_redcap_reports(project_filter):
+def update_redcap_reports(project_filter, snapshot=None):
     results = []
 
     # Get list of projects from main redcap
-    try:
-        logging.info('connecting to redcap')
-        i = utils.get_projectid("main", shared.KEYFILE)
-        k = utils.get_projectkey(i, shared.KEYFILE)
-        mainrc = redcap.Project(shared.API_URL, k)
-    except Exception as err:
-        logging.error(f'failed to connect to main redcap:{err}')
-        return
+    if snapshot is None:
+        snapshot = get_main_snapshot()
+        if snapshot is None:
+            return
+
+    mainrc = snapshot.mainrc
 
     # Get list of projects
-    maindata = mainrc.export_records(forms=['main'])
-    proj_list = sorted(list(set([x['main_name'] for x in maindata])))
+    proj_list = snapshot.project_names()
 
     with tempfile.TemporaryDirectory() as outdir:
         # Update each project
@@ -161,27 +175,18 @@ def update_redcap_reports(project_filter):
 
             logging.info(f'updating project {proj_name}:{filename}')
 
-            proj_data = mainrc.export_records(
-                forms=['main'], records=[proj_name]).pop()
+            proj_data = snapshot.project_record(proj_name)
 
             # Get phantom project name
             phan_project = proj_data.get('main_phanproject', '')
 
             # Get the scantypes, assrtypes from scanning forms
-            scan_data = mainrc.export_records(
-                forms=['scanning'],
-                records=[proj_name],
-                export_checkbox_labels=True,
-                raw_or_label='label')
-
-            for cur_data in scan_data:
-                for k, v in cur_data.items():
-                    # Append the scan/assr types for this scanning record
-                    if v and k.startswith('scanning_scantypes'):
-                        scantypes.append(v)
-
-                    if v and k.startswith('scanning_proctypes'):
-                        assrtypes.append(v)
+            for cur_data in snapshot.repeats('scanning', proj_name):
+                # Append the scan/assr types for this scanning record
+                scantypes += snapshot.checked_labels(
+                    cur_data, 'scanning_scantypes')
+                assrtypes += snapshot.checked_labels(
+                    cur_data, 'scanning_proctypes')
 
             # Make the lists unique
             scantypes = list(set((scantypes)))
@@ -251,22 +256,32 @@ def upload_report(filename, mainrc, project_name):
         logging.error(f'error uploading:{err}')
 
 
-def check_issues(project_filter):
+def load_audit_durations():
+    from .audits import load_durations
+
+    df = load_durations()
+    df['SECONDS'] = df['SECONDS'].astype(float).round(1)
+    return df
+
+
+def check_issues(project_filter, snapshot=None):
     from .audits import run_audits, update_issues
 
     try:
-        logging.info('connecting to redcap')
-        i = utils.get_projectid("main", shared.KEYFILE)
-        k = utils.get_projectkey(i, shared.KEYFILE)
-        mainrc = redcap.Project(shared.API_URL, k)
+        if snapshot is None:
+            snapshot = get_main_snapshot()
+            if snapshot is None:
+                return
+
+        mainrc = snapshot.mainrc
 
         # Identify current issues by running audit
         logging.info('running audits to find issues')
-        issues = run_audits(mainrc, project_filter)
+        issues = run_audits(mainrc, project_filter, snapshot=snapshot)
 
         # Save issues to redcap
         logging.info('updating check_issues')
-        update_issues(issues, mainrc, project_filter)
+        update_issues(issues, mainrc, project_filter, snapshot=snapshot)
 
     except Exception as err:
         logging.error(f'failed to connect to main redcap:{err}')
@@ -4,11 +4,14 @@ import logging
 from datetime import datetime
 import tempfile
 
+import numpy as np
 import pandas as pd
 from fpdf import FPDF
 import redcap
 
 import utils
+from .secondary import SecondaryIndex
+from .snapshot import MainSnapshot
 
 
 # Compares two REDCap projects, as First and Second where Second is the
@@ -18,6 +21,10 @@ import utils
 # Output files are named with the specified prefix.
 
 
+# Columns of repeating instruments in an export, blank for other rows
+REPEAT_COLUMNS = ['redcap_repeat_instrument', 'redcap_repeat_instance']
+
+
 # Names and descriptions of the sheets in the excel output file
 SHEETS = [{
 'name': 'Mismatches',
@@ -177,14 +184,17 @@ def add_sheet_description(pdf, name, description):
     pdf.multi_cell(w=6.3, h=0.4, txt=description, border='B', ln=1, align='L')
 
 
-def get_fields(p1, p2):
-    # Get all the records so we can check for all nan
-    df = p2.export_records(format_type='df')
-
+def get_fields(p1, p2, df2):
+    # Find the fields that are used in the second from its export
     common_fields = sorted(list(set(p1.field_names) & set(p2.field_names)))
     p1_only_fields = sorted(list(set(p1.field_names) - set(p2.field_names)))
     p2_only_fields = sorted(list(set(p2.field_names) - set(p1.field_names)))
-    p2_used_fields = sorted(list((df.dropna(how='all', axis=1)).columns))
+
+    # The record id is the key so it's never compared
+    p2_used_fields = sorted([
+        k for k in common_fields
+        if k != p2.def_field and k in df2 and (df2[k] != '').any()])
+
     p2_nan_fields = sorted(list(set(common_fields) - set(p2_used_fields)))
     compare_fields = sorted(list(set(common_fields) - set(p2_nan_fields)))
 
@@ -244,121 +254,71 @@ def write_excel(info, outfile):
         write_sheet(info['fields']['p2_nan'], w, 'Fields2ndNan')
 
 
-def compare_projects(p1, p2):
+def compare_projects(p1, p2, secondary_ids=None):
     # Compares two redcap projects and returns the results
     results = {}
-    missing_subjects = []
-    missing_events = []
-    missing_values = []
-    mismatches = []
     sec_field = None
 
+    if secondary_ids is None:
+        index1 = SecondaryIndex(p1)
+    else:
+        index1 = secondary_ids.get(p1)
+
     # Create index of record ID to subject ID in p1
     def_field = p1.def_field
-    sec_field = p1.export_project_info()['secondary_unique_field']
+    sec_field = index1.sec_field
     if sec_field:
-        rec = p1.export_records(fields=[def_field, sec_field])
-        id2subj1 = {x[def_field]: x[sec_field] for x in rec if x[sec_field]}
+        id2subj1 = index1.id2subj
 
         # Create index of subject ID to record ID in p2
-        def_field = p2.def_field
-        sec_field = p2.export_project_info()['secondary_unique_field']
-        rec = p2.export_records(fields=[def_field, sec_field])
-        subj2id2 = {x[sec_field]: x[def_field] for x in rec if x[sec_field]}
-
-    # Determine which fields to compare
-    fields = get_fields(p1, p2)
-    compare_fields = fields['compare']
-
-    # Get the records from the First project
-    records1 = p1.export_records()
-
-    # Compare each record
-    for r1 in records1:
-        rid1 = r1[def_field]
-        eid = r1['redcap_event_name']
-
-        # Get the subject number for this record
-        if sec_field:
-            try:
-                sid = id2subj1[rid1]
-            except KeyError as err:
-                logging.debug(f'blank subject ID for record:{rid1}:{err}')
-                continue
+        if secondary_ids is None:
+            subj2id2 = SecondaryIndex(p2).subj2id
         else:
-            # No secondary id, use main id
-            sid = rid1
-
-        # Check that we already found as missing
-        if sid in missing_subjects:
-            # Skip this subject, already missing
-            logging.debug(f'subject already missing:{sid}')
-            continue
-
-        if (sid, eid) in missing_events:
-            # Skip this event, already missing
-            logging.debug(f'event already missing:{sid},{eid}')
-            continue
+            subj2id2 = secondary_ids.get(p2).subj2id
 
-        # Get id in the secondary redcap project
-        if sec_field:
-            # Find the record to compare in second db by
-            # using subject id to find correct record by using and index
-            # then we query by record id
-            try:
-                rid = subj2id2[sid]
-            except KeyError as err:
-                logging.debug(f'missing subject:{rid1}:{err}')
-                missing_subjects.append(sid)
-                continue
-        else:
-            # No secondary id, use main id
-            rid = sid
+    # Get the records from the second with all the common fields, then
+    # determine which fields to compare from the same export
+    df2 = export_frame(p2, sorted(set(p1.field_names) & set(p2.field_names)))
+    fields = get_fields(p1, p2, df2)
+    compare_fields = fields['compare']
 
-        _rrname = r1.get('redcap_repeat_instrument', '')
-        _rrnum = r1.get('redcap_repeat_instance', '')
-        logging.debug(f'comparing:{sid},{eid},{_rrname},{_rrnum}')
+    # Get the records from the first with only the fields to compare
+    df1 = export_frame(p1, compare_fields)
 
-        r1['sid'] = sid
-        try:
-            e2 = p2.export_records(
-                records=[rid], events=[eid], fields=compare_fields)
-            e2_count = len(e2)
-
-            if e2_count == 0:
-                logging.debug(f'No record in double:{rid}:{sid}:{eid}')
-                missing_events.append((sid, eid))
-                continue
-            elif e2_count > 1:
-                # Handle multiple records for event
-                # Try to find a record
-                # that completely matches and continue, if none are found
-                # append the mismatches
-                mism = misv = None
-                for i in range(e2_count):
-                    r2 = e2[i]
-                    match_found = False
-                    (mism, misv) = compare_records(r1, r2, compare_fields)
-                    if not mism and not misv:
-                        # we have an exact match, so we good, exit the loop
-                        match_found = True
-                        break
-
-                if not match_found:
-                    # Did not find perfect match
-                    mismatches += mism
-                    missing_values += misv
-
-            else:
-                assert(e2_count == 1)
-                r2 = e2[0]
-                (mism, misv) = compare_records(r1, r2, compare_fields)
-                mismatches += mism
-                missing_values += misv
-
-        except Exception as err:
-            logging.debug(f'missing event:{err}')
-            missing_events.append((sid, eid))
+    # Get the subject number for each record
+    if sec_field:
+        df1['SUBJECT'] = df1[def_field].map(id2subj1)
+        _blank = df1['SUBJECT'].isna()
+        if _blank.any():
+            logging.debug(f'blank subject ID for records:{_blank.sum()}')
+            df1 = df1[~_blank].copy()
+
+        # Find the record to compare in second db by using subject id
+        df1['RECORD2'] = df1['SUBJECT'].map(subj2id2)
+    else:
+        # No secondary id, use main id
+        df1['SUBJECT'] = df1[def_field]
+        df1['RECORD2'] = df1[def_field]
+
+    # Subjects with no record in the second
+    _missing = df1['RECORD2'].isna()
+    missing_subjects = list(pd.unique(df1.loc[_missing, 'SUBJECT']))
+    df1 = df1[~_missing].astype({'RECORD2': str})
+
+    # Events with no rows in the second
+    _keys = ['RECORD2', 'redcap_event_name']
+    df2['RECORD2'] = df2[p2.def_field]
+    _found = pd.MultiIndex.from_frame(df1[_keys]).isin(
+        pd.MultiIndex.from_frame(df2[_keys]))
+    _events = df1.loc[~_found, ['SUBJECT', 'redcap_event_name']]
+    missing_events = list(_events.drop_duplicates().itertuples(
+        index=False, name=None))
+    df1 = df1[_found]
+
+    # Compare each record to the rows of the same event in the second
+    (mismatches, missing_values) = compare_records(df1, df2, compare_fields)
+    mismatches = list_issues(mismatches)
+    missing_values = list_issues(missing_values)
 
     # Count results
     results['counts'] = {
@@ -368,8 +328,7 @@ def compare_projects(p1, p2):
         'mismatches': len(mismatches),
     }
 
-    # Convert subjects list of dicts, we do this here so we can keep
-    # a simple list during the loop to check for already missing
+    # Convert subjects to list of dicts
     if missing_subjects:
         missing_subjects = [{'SUBJECT': s} for s in missing_subjects]
     else:
@@ -412,53 +371,118 @@ def compare_projects(p1, p2):
     return results
 
 
-def compare_records(r1, r2, fields, show_one_null=False, show_two_null=True):
-    mismatches = []
-    misvalues = []
+def export_frame(project, fields):
+    # Export the fields of all records in one request, as a dataframe with
+    # blanks where the repeat columns don't apply
+    fields = [project.def_field] + [x for x in fields if x != project.def_field]
+    df = pd.DataFrame(project.export_records(fields=fields), dtype=object)
+    for k in fields + ['redcap_event_name'] + REPEAT_COLUMNS:
+        if k not in df:
+            df[k] = ''
+
+    return df.fillna('').astype(str)
+
+
+def normalize_values(df, fields):
+    # Values as compared, stripped and lowercase so blanks are empty
+    return df[fields].apply(lambda x: x.str.strip().str.lower()).to_numpy()
+
+
+def compare_records(df1, df2, fields, show_one_null=False, show_two_null=True):
+    # Compare records of the first to the rows of the same event in the
+    # second. Returns tables of mismatches and missing values with one row
+    # for each field of each record.
+    fields = list(fields)
+    keys = ['RECORD2', 'redcap_event_name']
+
+    # Normalize each side once
+    norm1 = normalize_values(df1, fields)
+    norm2 = normalize_values(df2, fields)
+
+    # Pair each record with every row of the event, events with several rows
+    # have one pair per row
+    pairs = pd.merge(
+        df1[keys].assign(ROW1=np.arange(len(df1))),
+        df2[keys].assign(ROW2=np.arange(len(df2))),
+        on=keys)
+    row1 = pairs['ROW1'].to_numpy()
+    row2 = pairs['ROW2'].to_numpy()
+    logging.debug(f'comparing:{len(df1)} records:{len(pairs)} pairs')
+
+    # Build a mask for each field
+    mismatches = np.zeros((len(pairs), len(fields)), dtype=bool)
+    misvalues = np.zeros((len(pairs), len(fields)), dtype=bool)
+    for i in range(len(fields)):
+        v1 = norm1[row1, i]
+        v2 = norm2[row2, i]
+        blank1 = (v1 == '')
+        blank2 = (v2 == '')
+
+        if show_one_null:
+            # First is blank
+            mismatches[:, i] = blank1
+
+        if show_two_null:
+            # First has value, Second is blank
+            misvalues[:, i] = ~blank1 & blank2
 
-    for k in sorted(fields):
-        # Get value from the first redcap
-        try:
-            v1 = r1[k]
-        except KeyError:
-            logging.error(f'r1:KeyError:{k}')
-            continue
+        # Both have values, but don't match
+        mismatches[:, i] |= ~blank1 & ~blank2 & (v1 != v2)
 
-        # Get the value from the second
-        try:
-            v2 = r2[k]
-        except KeyError:
-            logging.error(f'r2:KeyError:{k}')
-            continue
+    # Records with an exact match to any row in the event are good,
+    # otherwise we report the last row of the event
+    exact = ~(mismatches.any(axis=1) | misvalues.any(axis=1))
+    good = np.zeros(len(df1), dtype=bool)
+    good[row1[exact]] = True
+    order = np.lexsort((row2, row1))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = row1[order][1:] != row1[order][:-1]
+    report = order[last]
+    report = report[~good[row1[report]]]
 
-        mis = {
-            'SUBJECT': r1['sid'],
-            'EVENT': r1['redcap_event_name'],
-            'FIELD': k,
-        }
+    # Tables in long format, in order of records and then fields
+    tables = []
+    for mask in [mismatches, misvalues]:
+        rows, cols = np.nonzero(mask[report])
+        r1 = row1[report][rows]
+        r2 = row2[report][rows]
 
-        if 'redcap_repeat_instrument' in r1 and r1['redcap_repeat_instance']:
-            mis['REPEAT_INSTANCE'] = r1['redcap_repeat_instance']
+        # Show the values when both have values
+        both = (norm1[r1, cols] != '') & (norm2[r2, cols] != '')
+        v1 = df1[fields].to_numpy()[r1, cols]
+        v2 = df2[fields].to_numpy()[r2, cols]
 
-        if v1 == '':
-            # Both blank
-            if show_one_null:
-                mismatches.append(mis)
-        elif v2 == '':
-            # First has value, Second is blank
-            if show_two_null:
-                misvalues.append(mis)
-
-        elif str(v1).strip().lower() != str(v2).strip().lower():
-            # Both have values, but don't match, show the values
-            mis['1stVALUE'] = v1
-            mis['2ndVALUE'] = v2
-            mismatches.append(mis)
-        else:
-            # it matches, so do nothing
-            pass
+        tables.append(pd.DataFrame({
+            'SUBJECT': df1['SUBJECT'].to_numpy()[r1],
+            'EVENT': df1['redcap_event_name'].to_numpy()[r1],
+            'FIELD': np.array(fields, dtype=object)[cols],
+            'REPEAT_INSTANCE': df1['redcap_repeat_instance'].to_numpy()[r1],
+            '1stVALUE': np.where(both, v1, ''),
+            '2ndVALUE': np.where(both, v2, ''),
+        }))
+
+    return (tables[0], tables[1])
+
+
+def list_issues(table):
+    # Convert the table to a list of dicts, leaving out the repeat instance
+    # and values where blank
+    issues = []
+
+    for r in table.itertuples(index=False, name=None):
+        mis = dict(zip(['SUBJECT', 'EVENT', 'FIELD'], r[:3]))
+
+        if r[3]:
+            mis['REPEAT_INSTANCE'] = r[3]
+
+        if r[4] != '':
+            # Both have values, show the values
+            mis['1stVALUE'] = r[4]
+            mis['2ndVALUE'] = r[5]
+
+        issues.append(mis)
 
-    return (mismatches, misvalues)
+    return issues
 
 
 def write_results(results, pdf_file, excel_file):
@@ -505,19 +529,19 @@ def test_finish(outdir, outpref):
     write_results(info, pdf_file, excel_file)
 
 
-def run_compare(p1, p2, outdir, outpref):
+def run_compare(p1, p2, outdir, outpref, secondary_ids=None):
     # Build filenames
     excel_file = os.path.join(outdir, f'{outpref}.xlsx')
     pdf_file = os.path.join(outdir, f'{outpref}.pdf')
 
     # Get the compare results
-    results = compare_projects(p1, p2)
+    results = compare_projects(p1, p2, secondary_ids=secondary_ids)
 
     # Write output files
     write_results(results, pdf_file, excel_file)
 
 
-def run_project_compare(mainrc, proj_maindata, keyfile):
+def run_project_compare(mainrc, proj_maindata, keyfile, secondary_ids=None):
     proj_name = proj_maindata['main_name']
     proj_primary = proj_maindata['project_primary']
     proj_secondary = proj_maindata['project_secondary']
@@ -546,7 +570,7 @@ def run_project_compare(mainrc, proj_maindata, keyfile):
 
         # Run it
         logging.info(f'compare {proj_name}:{proj_primary} to {proj_secondary}')
-        run_compare(p1, p2, outdir, outpref)
+        run_compare(p1, p2, outdir, outpref, secondary_ids=secondary_ids)
 
         logging.info(f'handling results')
 
@@ -594,12 +618,13 @@ def run_project_compare(mainrc, proj_maindata, keyfile):
             logging.error(f'error uploading:{err}')
 
 
-def update_reports(mainrc, keyfile, project_filter):
+def update_reports(mainrc, keyfile, project_filter, snapshot=None):
     logging.info('running compare')
-    maindata = mainrc.export_records()
+    if snapshot is None:
+        snapshot = MainSnapshot(mainrc)
 
     # Get list of projects
-    proj_list = sorted(list(set([x['main_name'] for x in maindata])))
+    proj_list = snapshot.project_names()
 
     # Now iterate each project
     for p in proj_list:
@@ -610,11 +635,12 @@ def update_reports(mainrc, keyfile, project_filter):
         logging.info(f'comparing double entry for project:{p}')
 
         # Get main data for project
-        proj_maindata = {}
-        for rec in maindata:
-            if rec['main_name'] == p and rec['redcap_repeat_instrument'] == '':
-                proj_maindata = rec
+        proj_maindata = snapshot.project_record(p)
 
-        run_project_compare(mainrc, proj_maindata, keyfile)
+        run_project_compare(
+            mainrc,
+            proj_maindata,
+            keyfile,
+            secondary_ids=snapshot.secondary_ids)
 
     return
@@ -1,7 +1,7 @@
 import logging
 from pathlib import Path
 
-from dash import dcc, html
+from dash import dcc, html, dash_table as dt
 from dash.dependencies import Input, Output
 import dash
 
@@ -44,6 +44,17 @@ def get_content():
         html.Button(
             'Run Selected',
             id='button-admin-run'),
+        html.Br(),
+        # Show how long each project took in the last audit, filled in by
+        # the callback so it's updated after each run
+        html.P('LAST AUDIT'),
+        dt.DataTable(
+            columns=[],
+            data=[],
+            sort_action='native',
+            id='datatable-admin-audits',
+            style_cell={'textAlign': 'left', 'padding': '5px 5px 0px 5px'},
+            fill_width=False),
     ]
 
     return admin_content
@@ -101,6 +112,8 @@ def _get_graph_content():
         Output('dropdown-admin-projects', 'options'),
         Output('dropdown-admin-types', 'options'),
         Output('loading-admin', 'children'),
+        Output('datatable-admin-audits', 'data'),
+        Output('datatable-admin-audits', 'columns'),
     ],
     [
         Input('button-admin-run', 'n_clicks'),
@@ -113,6 +126,7 @@ def update_admin(
     selected_types,
 ):
     logging.info(f'updating:{selected_types}:{selected_projects}')
+    snapshot = None
 
     # Handle run
     ctx = dash.callback_context
@@ -120,23 +134,26 @@ def update_admin(
         # Run reports if button clicked
         logging.info('run:clicks={}'.format(n_clicks_run))
 
-        if 'Double Entry Report' in selected_types:
+        # Export main redcap once for everything we run
+        snapshot = data.get_main_snapshot()
+
+        if snapshot and 'Double Entry Report' in selected_types:
             logging.info(f'updating double reports:{selected_projects}')
-            data.update_double_reports(selected_projects)
+            data.update_double_reports(selected_projects, snapshot=snapshot)
 
-        if 'Monthly Progress Report' in selected_types:
+        if snapshot and 'Monthly Progress Report' in selected_types:
             logging.debug(f'updating progress reports:{selected_projects}')
-            data.update_redcap_reports(selected_projects)
+            data.update_redcap_reports(selected_projects, snapshot=snapshot)
 
-        if 'Check Issues' in selected_types:
+        if snapshot and 'Check Issues' in selected_types:
             logging.debug('running audits to check issues')
-            data.check_issues(selected_projects)
+            data.check_issues(selected_projects, snapshot=snapshot)
 
     # Return result
     logging.debug('update_all:returning data')
 
     # Update lists of possible options for dropdowns
-    projects = utils.make_options(data.get_projects())
+    projects = utils.make_options(data.get_projects(snapshot=snapshot))
     types = utils.make_options([
         'Double Entry Report',
         'Monthly Progress Report',
@@ -145,4 +162,9 @@ def update_admin(
 
     graphs = _get_graph_content()
 
-    return [projects, types, graphs]
+    # Durations of the last audit, including one we just ran
+    df = data.load_audit_durations()
+    records = df.to_dict('records')
+    columns = utils.make_columns(df.columns)
+
+    return [projects, types, graphs, records, columns]
@@ -569,11 +569,10 @@ def plot_stats(df, proctype):
         image = Image.open(io.BytesIO(_png))
         return image
 
-    # Filter var list to only include those that have data
-    var_list = [x for x in df.columns if not pd.isnull(df[x]).all()]
-
-    # Filter var list to only stats variables
-    var_list = [x for x in get_variables() if x in var_list]
+    # Filter var list to only stats variables for this proctype that have
+    # data, counting values in all columns at once
+    counts = df.notna().sum()
+    var_list = [x for x in get_variables([proctype]) if counts.get(x, 0) > 0]
 
     # Determine how many boxplots we're making, depends on how many vars, use
     # minimum so graph doesn't get too small
@@ -0,0 +1,44 @@
+import logging
+import threading
+
+
+# Maps between record ID and subject ID (the secondary unique field) of the
+# redcaps used in an admin run. Each redcap is exported once per run no matter
+# how many audits or compares use it, they are keyed by the project token.
+
+
+class SecondaryIndex(object):
+    def __init__(self, project):
+        self.def_field = project.def_field
+        self.sec_field = project.export_project_info()[
+            'secondary_unique_field']
+        self.id2subj = {}
+        self.subj2id = {}
+
+        if self.sec_field:
+            rec = project.export_records(
+                fields=[self.def_field, self.sec_field])
+            for x in rec:
+                if x[self.sec_field]:
+                    self.id2subj[x[self.def_field]] = x[self.sec_field]
+                    self.subj2id[x[self.sec_field]] = x[self.def_field]
+
+
+class SecondaryIds(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._indexes = {}
+
+    def get(self, project):
+        # Returns the index for the project, built the first time. Other
+        # projects can be built at the same time.
+        with self._lock:
+            lock = self._locks.setdefault(project.token, threading.Lock())
+
+        with lock:
+            if project.token not in self._indexes:
+                logging.info('loading secondary ids')
+                self._indexes[project.token] = SecondaryIndex(project)
+
+        return self._indexes[project.token]
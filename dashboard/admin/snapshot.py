@@ -0,0 +1,80 @@
+import logging
+import re
+from types import MappingProxyType
+
+from .secondary import SecondaryIds
+
+
+# One export of main redcap shared by every admin task in a run. Records are
+# read-only so one task can't change what the next one sees, anything that
+# writes to main still goes through the project in mainrc. The secondary ids
+# of other redcaps are also shared for the run.
+
+
+class MainSnapshot(object):
+    def __init__(self, mainrc):
+        self.mainrc = mainrc
+
+        logging.info('exporting main redcap snapshot')
+        self.records = tuple(
+            MappingProxyType(x) for x in mainrc.export_records())
+        logging.info(f'main snapshot has {len(self.records)} records')
+
+        # Checkbox choices from the metadata so we can find labels
+        # without exporting again with labels
+        self.choices = {}
+        for f in mainrc.metadata:
+            if f['field_type'] == 'checkbox':
+                self.choices[f['field_name']] = parse_choices(
+                    f['select_choices_or_calculations'])
+
+        self.secondary_ids = SecondaryIds()
+
+    def project_names(self):
+        return sorted(list(set([x['main_name'] for x in self.records])))
+
+    def project_record(self, project):
+        # The main (not repeating) record for the project
+        proj_maindata = {}
+        for rec in self.records:
+            if rec['main_name'] == project and \
+                    rec['redcap_repeat_instrument'] == '':
+                proj_maindata = rec
+
+        return proj_maindata
+
+    def repeats(self, instrument, project=None):
+        # Records of the repeating instrument, for one project if given
+        return [x for x in self.records if (
+            x['redcap_repeat_instrument'] == instrument and
+            (project is None or x['main_name'] == project))]
+
+    def checked_labels(self, record, prefix):
+        # Labels of the checked choices in checkbox fields starting with
+        # prefix, same as the values exported with checkbox labels
+        labels = []
+        for field, choices in self.choices.items():
+            if not field.startswith(prefix):
+                continue
+
+            for code, label in choices.items():
+                if record.get(f'{field}___{code}', '') == '1':
+                    labels.append(label)
+
+        return labels
+
+
+def parse_choices(choices):
+    # Parse redcap choices like "1, T1 | 2, fMRI" to a dict of code to label
+    result = {}
+    for c in choices.split('|'):
+        if ',' not in c:
+            continue
+
+        code, label = c.split(',', 1)
+        # Export names have the code in lowercase with anything other than
+        # letters and digits replaced by underscores, same as redcap
+        code = re.sub('[^a-z0-9]', '_', code.strip().lower())
+        result[code] = label.strip()
+
+    return result
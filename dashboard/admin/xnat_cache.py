@@ -0,0 +1,70 @@
+import logging
+import threading
+
+from dax import XnatUtils
+
+import utils
+
+
+# Longest we wait for another thread listing the same project, in seconds
+LIST_TIMEOUT = 600
+
+
+# XNAT session listings for one audit run, each project is listed at most
+# once. The audits run in parallel and one can be abandoned while it waits on
+# XNAT, so each listing uses its own interface and holds a lock for just that
+# project. Listings are kept as sets so checking for a session doesn't scan
+# the whole project.
+
+
+class SessionCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._exists = {}
+        self._labels = {}
+        self._vuiisids = {}
+
+    def _get(self, cache, kind, project, load):
+        # Returns the cached value for the project, loading it the first
+        # time. Other projects can be loaded at the same time.
+        with self._lock:
+            if project in cache:
+                return cache[project]
+
+            lock = self._locks.setdefault((kind, project), threading.Lock())
+
+        if not lock.acquire(timeout=LIST_TIMEOUT):
+            raise TimeoutError(f'timed out waiting for {kind}:{project}')
+
+        try:
+            if project not in cache:
+                logging.debug(f'listing {kind}:{project}')
+                with XnatUtils.InterfaceTemp(xnat_retries=0) as xnat:
+                    cache[project] = load(xnat, project)
+
+            return cache[project]
+        finally:
+            lock.release()
+
+    def project_exists(self, project):
+        return self._get(
+            self._exists,
+            'project',
+            project,
+            lambda xnat, p: xnat.select.project(p).exists())
+
+    def session_labels(self, project):
+        return self._get(
+            self._labels,
+            'session labels',
+            project,
+            lambda xnat, p: frozenset(utils.session_label_list(xnat, p)))
+
+    def session_vuiisids(self, project):
+        return self._get(
+            self._vuiisids,
+            'session vuiisids',
+            project,
+            lambda xnat, p: frozenset(utils.session_vuiisid_list(xnat, p)))
+
@@ -1,5 +1,7 @@
 import logging
 import os
+import threading
+from datetime import datetime, timedelta
 
 import pandas as pd
 import dax
@@ -9,6 +11,57 @@ import utils
 import shared
 
 
+# Open issues are kept in a store synced from redcap. A sync only exports the
+# records changed since the last sync, a full sync of the open issues is done
+# when the store is older than ISSUES_FULL_SYNC to catch deleted records.
+ISSUES_FULL_SYNC = timedelta(days=1)
+
+# Fields we index for dropdown options and filtering
+INDEX_FIELDS = ['PROJECT', 'CATEGORY', 'SOURCE']
+
+ISSUES_COLUMNS = [
+    'ID', 'LABEL', 'PROJECT', 'SUBJECT', 'SESSION',
+    'EVENT', 'FIELD', 'CATEGORY', 'STATUS', 'SOURCE',
+    'DESCRIPTION', 'DATETIME'
+]
+
+_index = None
+_index_mtime = None
+_lock = threading.Lock()
+
+
+class IssueIndex(object):
+    # Issues with the positions of the rows for each value of the index
+    # fields, so options and filters don't need to scan the data
+    def __init__(self, df, fields=INDEX_FIELDS):
+        self.df = df
+        self.positions = {}
+        for f in fields:
+            self.positions[f] = df.groupby(f, sort=False).indices
+
+    def options(self, field):
+        return sorted([x for x in self.positions[field].keys() if x])
+
+    def select(self, **selected):
+        # Returns the rows matching any of the values for each field,
+        # fields with no values selected are not filtered
+        rows = None
+        for f, values in selected.items():
+            if not values:
+                continue
+
+            _rows = set()
+            for v in values:
+                _rows.update(self.positions[f].get(v, []))
+
+            rows = _rows if rows is None else (rows & _rows)
+
+        if rows is None:
+            return self.df.copy()
+
+        return self.df.iloc[sorted(rows)]
+
+
 # This is where we save our cache of the data
 def get_filename():
     #return 'DATA/issuesdata.pkl'
@@ -20,12 +73,22 @@ def get_filename():
     return filename
 
 
+# This is where we keep the issues synced from redcap
+def get_store_filename():
+    datadir = 'DATA'
+    if not os.path.isdir(datadir):
+        os.mkdir(datadir)
+
+    filename = f'{datadir}/issuesstore.pkl'
+    return filename
+
+
 def get_data(xnat, proj_filter):
     df = pd.DataFrame()
     dfi = pd.DataFrame()
 
     logging.info('loading issues from REDCap')
-    dfi = load_issues()
+    dfi = sync_issues()
 
     # Concatentate all the dataframes into one
     df = pd.concat([dfi], ignore_index=True)
@@ -38,29 +101,73 @@ def get_data(xnat, proj_filter):
     return df
 
 
-def load_issues():
-    # type,project,subject,session,date,event,field,description
+def sync_issues(full=False):
+    # Returns the open issues after updating the store from redcap
+    filename = get_store_filename()
+
+    store = None
+    if os.path.exists(filename):
+        logging.debug(f'reading issues store:{filename}')
+        store = pd.read_pickle(filename)
+
+    if store and not full:
+        full = (datetime.now() - store['full']) > ISSUES_FULL_SYNC
+
+    # Changes made during the export get picked up by the next sync
+    synced = datetime.now()
 
-    # Connect to the main redcap to load currently open issues
     try:
-        logging.info('connecting to redcap')
-        # TODO: get main id from keyfile
-        i = utils.get_projectid("main", shared.KEYFILE)
-        k = utils.get_projectkey(i, shared.KEYFILE)
-        project = redcap.Project(shared.API_URL, k)
-        logging.info('exporting issues records')
-        df = project.export_records(forms=['main', 'issues'], format_type='df')
-        df = df[df['redcap_repeat_instrument'] == 'issues']
+        project = connect_main()
+        if store is None or full:
+            logging.info('exporting all open issues')
+            df = project.export_records(
+                forms=['main', 'issues'],
+                filter_logic="[issues_complete] <> '2'",
+                format_type='df')
+            df = transform_issues(df)
+            store = {'data': df, 'full': synced}
+        else:
+            logging.info(f'exporting issues changed since:{store["synced"]}')
+            df = project.export_records(
+                forms=['main', 'issues'],
+                date_begin=store['synced'],
+                format_type='df')
+
+            # Replace the issues of every record that changed, this also
+            # removes issues completed or deleted in those records
+            changed = df.index.unique()
+            logging.info(f'{len(changed)} records with changed issues')
+            dfs = store['data']
+            df = pd.concat([
+                dfs[~dfs['PROJECT'].isin(changed)],
+                transform_issues(df)])
+            store['data'] = df
     except Exception as err:
         logging.error(f'failed to load issues:{err}')
-        return pd.DataFrame(columns=[
-            'ID', 'LABEL', 'PROJECT', 'SUBJECT', 'SESSION',
-            'EVENT', 'FIELD', 'CATEGORY', 'STATUS', 'SOURCE',
-            'DESCRIPTION', 'DATETIME'
-        ])
+        return pd.DataFrame(columns=ISSUES_COLUMNS)
+
+    store['synced'] = synced
+    pd.to_pickle(store, filename)
+
+    return store['data']
+
 
+def connect_main():
+    logging.info('connecting to redcap')
+    # TODO: get main id from keyfile
+    i = utils.get_projectid("main", shared.KEYFILE)
+    k = utils.get_projectkey(i, shared.KEYFILE)
+    return redcap.Project(shared.API_URL, k)
+
+
+def transform_issues(df):
+    # type,project,subject,session,date,event,field,description
     logging.debug('transforming records')
-    df = df[df['issues_complete'].astype(int).astype(str) != '2']
+    if df.empty or 'redcap_repeat_instrument' not in df:
+        return pd.DataFrame(columns=ISSUES_COLUMNS)
+
+    df = df[df['redcap_repeat_instrument'] == 'issues']
+    df = df[df['issues_complete'].astype(int).astype(str) != '2'].copy()
 
     df['PROJECT'] = df.index
     df.rename(inplace=True, columns={
@@ -100,21 +207,31 @@ def run_refresh(filename):
 
     return result
 
-def load_field_options(fieldname):
+
+def load_index(refresh=False):
+    # Returns the index of the issues, rebuilt when the file changes
+    global _index, _index_mtime
+
     filename = get_filename()
 
-    if not os.path.exists(filename):
-        logging.debug('refreshing data for file:{}'.format(filename))
-        run_refresh(filename)
+    with _lock:
+        if refresh or not os.path.exists(filename):
+            run_refresh(filename)
+
+        mtime = None
+        if os.path.exists(filename):
+            mtime = os.path.getmtime(filename)
 
-    logging.debug('reading data from file:{}'.format(filename))
-    df = pd.read_pickle(filename)
+        if _index is None or mtime != _index_mtime:
+            logging.info('reading data from file:{}'.format(filename))
+            _index = IssueIndex(read_data(filename))
+            _index_mtime = mtime
 
-    _options = df[fieldname].unique()
+        return _index
 
-    _options = [x for x in _options if x]
 
-    return sorted(_options)
+def load_field_options(fieldname):
+    return load_index().options(fieldname)
 
 
 def load_category_options():
@@ -130,13 +247,7 @@ def load_source_options():
 
 
 def load_data(refresh=False):
-    filename = get_filename()
-
-    if refresh or not os.path.exists(filename):
-        run_refresh(filename)
-
-    logging.info('reading data from file:{}'.format(filename))
-    return read_data(filename)
+    return load_index(refresh=refresh).df.copy()
 
 
 def read_data(filename):
@@ -144,11 +255,7 @@ def read_data(filename):
     if os.path.exists(filename):
         df = pd.read_pickle(filename)
     else:
-         df = pd.DataFrame(columns=[
-            'ID', 'LABEL', 'PROJECT', 'SUBJECT', 'SESSION',
-            'EVENT', 'FIELD', 'CATEGORY', 'STATUS', 'SOURCE',
-            'DESCRIPTION', 'DATETIME'
-        ])
+        df = pd.DataFrame(columns=ISSUES_COLUMNS)
 
     return df
 
@@ -158,23 +265,10 @@ def save_data(df, filename):
     df.to_pickle(filename)
 
 
-def filter_data(df, projects, categories, sources):
-    # Filter by project
-    if projects:
-        logging.debug('filtering by project:')
-        logging.debug(projects)
-        df = df[df['PROJECT'].isin(projects)]
-
-    # Filter by category
-    if categories:
-        logging.debug('filtering by category:')
-        logging.debug(categories)
-        df = df[(df['CATEGORY'].isin(categories))]
-
-    # Filter by source
-    if sources:
-        logging.debug('filtering by source:')
-        logging.debug(sources)
-        df = df[(df['SOURCE'].isin(sources))]
-
-    return df
+def filter_data(index, projects, categories, sources):
+    # Filter by project, category and source using the index
+    logging.debug(f'filtering:{projects}:{categories}:{sources}')
+    return index.select(
+        PROJECT=projects,
+        CATEGORY=categories,
+        SOURCE=sources)
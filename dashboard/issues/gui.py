@@ -153,21 +153,13 @@ def load_issues(refresh=False):
     return data.load_data(refresh=refresh)
 
 
-def load_category_options():
-    return data.load_category_options()
+def load_index(refresh=False):
+    return data.load_index(refresh=refresh)
 
 
-def load_project_options():
-    return data.load_project_options()
-
-
-def load_source_options():
-    return data.load_source_options()
-
-
-def filter_data(df, selected_project, selected_category, selected_source):
+def filter_data(index, selected_project, selected_category, selected_source):
     return data.filter_data(
-        df, selected_project, selected_category, selected_source)
+        index, selected_project, selected_category, selected_source)
 
 
 def was_triggered(callback_ctx, button_id):
@@ -215,17 +207,17 @@ def update_issues(
         refresh = True
 
     logging.debug('loading issues data')
-    df = load_issues(refresh=refresh)
+    index = load_index(refresh=refresh)
 
     # Update lists of possible options for dropdowns (could have changed)
     # make these lists before we filter what to display
-    projects = utils.make_options(load_project_options())
-    categories = utils.make_options(load_category_options())
-    sources = utils.make_options(load_source_options())
+    projects = utils.make_options(index.options('PROJECT'))
+    categories = utils.make_options(index.options('CATEGORY'))
+    sources = utils.make_options(index.options('SOURCE'))
 
     # Filter data based on dropdown values
     df = filter_data(
-        df,
+        index,
         selected_project,
         selected_category,
         selected_source)
@@ -0,0 +1,205 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+import redcap
+
+import utils
+from stats.params import registry
+import shared
+
+
+# Clinical covariates (demographics and per-event scores) for stats. Each
+# project configured in CLINICAL_PROJECTS is loaded from its primary redcap
+# at most once per CLINICAL_MAX_AGE and cached in DATA/stats/clinical-*.pkl
+
+
+# How long before we load clinical data from redcap again
+CLINICAL_MAX_AGE = timedelta(hours=12)
+
+DEMOGRAPHIC_COLUMNS = ['AGE', 'SEX', 'DEPRESS']
+
+# Each project has its own lock so different projects load at the same time
+_lock = threading.Lock()
+_locks = {}
+
+
+def get_filename(project):
+    datadir = 'DATA/stats'
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+
+    return f'{datadir}/clinical-{project}.pkl'
+
+
+def is_fresh(filename, max_age):
+    if not os.path.exists(filename):
+        return False
+
+    modified = datetime.fromtimestamp(os.path.getmtime(filename))
+    return (datetime.now() - modified) <= max_age
+
+
+def score_columns():
+    # All the score fields so the columns are the same for any projects
+    columns = []
+    for config in registry.get_clinical_projects().values():
+        for x in config.get('scores', {}).get('fields', []):
+            if x not in columns:
+                columns.append(x)
+
+    return columns
+
+
+def load_clinical(project, max_age=CLINICAL_MAX_AGE):
+    # Returns dict with demographics and scores for the project, None if the
+    # project does not have clinical data
+    config = registry.get_clinical_projects().get(project, None)
+    if not config:
+        return None
+
+    filename = get_filename(project)
+
+    with _lock:
+        lock = _locks.setdefault(project, threading.Lock())
+
+    with lock:
+        if is_fresh(filename, max_age):
+            logging.debug(f'reading clinical data from file:{filename}')
+            return pd.read_pickle(filename)
+
+        try:
+            clinical = export_clinical(config)
+        except Exception as err:
+            logging.error(f'failed to load clinical data:{project}:{err}')
+            if os.path.exists(filename):
+                logging.info('using old clinical data')
+                return pd.read_pickle(filename)
+
+            return None
+
+        utils.save_pickle(clinical, filename)
+
+    return clinical
+
+
+def export_clinical(config):
+    # Connect to the redcap project
+    k = utils.get_projectkeybyname(config['primary'], shared.KEYFILE)
+    logging.info('connecting to redcap')
+    _proj = redcap.Project(shared.API_URL, k)
+
+    # Load secondary ID once for both demographics and scores
+    def_field = _proj.def_field
+    sec_field = _proj.export_project_info()['secondary_unique_field']
+    rec = _proj.export_records(
+        fields=[def_field, sec_field],
+        format_type='df')
+    rec = rec.reset_index()
+    rec = rec.dropna(subset=[sec_field])
+    rec[sec_field] = rec[sec_field].astype(int).astype(str)
+    id2subj = rec.drop_duplicates(def_field).set_index(def_field)[sec_field]
+
+    return {
+        'demographics': export_demographics(
+            _proj, id2subj, config.get('demographics', {})),
+        'scores': export_scores(_proj, id2subj, config.get('scores', {})),
+    }
+
+
+def export_demographics(_proj, id2subj, config):
+    if not config:
+        return empty_demographics()
+
+    def_field = _proj.def_field
+    _fields = config.get('fields', {})
+    df = _proj.export_records(
+        raw_or_label='label',
+        format_type='df',
+        fields=[def_field] + list(_fields.keys()),
+        events=config.get('events', None))
+    df = df.reset_index()
+
+    # Transform for dashboard data
+    df['SUBJECT'] = df[def_field].map(id2subj)
+    df = df.rename(columns=_fields)
+    for k, v in config.get('values', {}).items():
+        df[k] = v
+
+    # A bit of cleanup
+    df = df.dropna(subset=['SUBJECT'])
+    for c in DEMOGRAPHIC_COLUMNS:
+        if c not in df:
+            df[c] = ''
+
+    df = df.set_index('SUBJECT', verify_integrity=True)
+    return df[DEMOGRAPHIC_COLUMNS].fillna('')
+
+
+def export_scores(_proj, id2subj, config):
+    if not config:
+        return empty_scores()
+
+    def_field = _proj.def_field
+    _fields = config.get('fields', [])
+    _map = config.get('events', {})
+    df = _proj.export_records(
+        raw_or_label='raw',
+        format_type='df',
+        fields=[def_field] + _fields,
+        events=list(_map.keys()))
+    df = df.reset_index()
+
+    # Map redcap record to subject and event to xnat session type
+    df['SUBJECT'] = df[def_field].map(id2subj)
+    df['SESSTYPE'] = df['redcap_event_name'].map(_map)
+
+    # Remove missing data, a subject missing one score keeps the others
+    df = df[['SUBJECT', 'SESSTYPE'] + _fields]
+    df = df.dropna(subset=['SUBJECT', 'SESSTYPE'])
+    df = df.dropna(subset=_fields, how='all')
+
+    # Force int format where we have all the values, otherwise leave
+    # the missing ones blank
+    for c in _fields:
+        if df[c].notna().all():
+            df[c] = df[c].astype(int)
+
+    df = df.sort_values('SUBJECT')
+    return df.set_index(['SUBJECT', 'SESSTYPE'])
+
+
+def empty_demographics():
+    df = pd.DataFrame(columns=['SUBJECT'] + DEMOGRAPHIC_COLUMNS)
+    return df.set_index('SUBJECT')
+
+
+def empty_scores():
+    df = pd.DataFrame(columns=['SUBJECT', 'SESSTYPE'] + score_columns())
+    return df.set_index(['SUBJECT', 'SESSTYPE'])
+
+
+def load_demographics(projects, max_age=CLINICAL_MAX_AGE):
+    # Demographics indexed by SUBJECT for all the projects
+    frames = [empty_demographics()]
+    for p in projects:
+        clinical = load_clinical(p, max_age=max_age)
+        if clinical is not None:
+            frames.append(clinical['demographics'])
+
+    df = pd.concat(frames, sort=False)
+    return df[~df.index.duplicated()]
+
+
+def load_scores(projects, max_age=CLINICAL_MAX_AGE):
+    # Scores indexed by SUBJECT, SESSTYPE for all the projects
+    frames = [empty_scores()]
+    for p in projects:
+        clinical = load_clinical(p, max_age=max_age)
+        if clinical is not None:
+            frames.append(clinical['scores'])
+
+    df = pd.concat(frames, sort=False)
+    return df[~df.index.duplicated()]
@@ -1,13 +1,17 @@
 import logging
 import os
+import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 import redcap
 import dax
 
 import utils
-from stats.params import STATS_RENAME, STATIC_COLUMNS, VAR_LIST
+from stats.params import STATIC_COLUMNS, registry
+import stats.clinical as clinical
+import stats.join as join
 import shared
 
 
@@ -15,13 +19,19 @@ import shared
 # REDCap (using keys in shared.keyfile)
 #
 # Note this app does not access ACCRE or SLURM. The ony local file access
-# is to write the cached data in a pickle file named statsdata.pkl
+# is to write the cached data in pickle files. Each stats redcap is cached
+# separately in DATA/stats/<project>-<proctype>-<resource>.pkl already merged
+# with XNAT session info. The combined data for the current selection is
+# saved in statsdata.pkl along with the names of the redcaps it was built
+# from, so a new selection only needs to export the redcaps not yet cached.
 
 # Now only loads the selected redcaps rather than loading them first and then
 # filtering
 
-# TODO: load_madrs_data() build event map from ccmutils redcap and dynamically
-# query primary database for each database that has madrs enabled in ccmutils
+# Clinical data such as demographics and MADRS is loaded by stats.clinical
+# for the projects in CLINICAL_PROJECTS
+
+# TODO: build clinical event map from ccmutils redcap instead of params
 
 
 SESS_URI = '/REST/experiments?xsiType=xnat:imagesessiondata\
@@ -36,6 +46,18 @@ xnat:imagesessiondata/date,\
 xnat:imagesessiondata/label'
 
 
+# Columns for making a row per subject
+PIVOT_INDEX = ['SUBJECT', 'PROJECT', 'AGE', 'SEX', 'DEPRESS', 'SITE']
+PIVOT_COLUMNS = ['SESSTYPE', 'TYPE']
+
+# Fields we always export from stats redcaps to identify the assessor
+STATS_ID_FIELDS = [
+    'record_id', 'experiment', 'proctype', 'project', 'proc_date']
+
+# How many stats redcaps we export at the same time
+MAX_EXPORT_WORKERS = 8
+
+
 SESS_RENAME = {
     'project': 'PROJECT',
     'subject_label': 'SUBJECT',
@@ -54,8 +76,9 @@ def get_vars():
     return get_variables()
 
 
-def get_variables():
-    return VAR_LIST
+def get_variables(proctypes=None):
+    # Vars in params order, limited to the proc types when we know them
+    return registry.get_vars_for(proctypes)
 
 
 def get_filename():
@@ -68,14 +91,110 @@ def get_filename():
     return filename
 
 
+def get_cachedir(report=False):
+    # Reports keep their own cache so they never write the files the
+    # dashboard is reading
+    datadir = 'DATA/stats'
+    if report:
+        datadir = 'DATA/stats/reports'
+
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+
+    return datadir
+
+
+def get_redcap_filename(name, report=False):
+    # Each stats redcap gets its own cache file
+    return f'{get_cachedir(report=report)}/{name}.pkl'
+
+
 def load_data(projects, proctypes, refresh=False):
+    return load_selection(projects, proctypes, refresh=refresh)['data']
+
+
+def load_selection(projects, proctypes, refresh=False):
+    # Returns dict with the data as one row per assessor in data and
+    # pivoted to one row per subject in subjects
     filename = get_filename()
 
-    if refresh or not os.path.exists(filename):
-        run_refresh(filename, projects, proctypes)
+    if not refresh:
+        # Try to use the data already combined for this selection
+        selection = read_selection(filename, projects, proctypes)
+        if selection is not None:
+            logging.info('read data from file:{}'.format(filename))
+            learn_vars(selection['data'])
+            return selection
+
+    return run_refresh(filename, projects, proctypes, refresh=refresh)
+
+
+def learn_vars(df):
+    # Keep track of which vars each proc type has, from the merged data so
+    # it's the same however the data was loaded
+    if df.empty or 'TYPE' not in df:
+        return
+
+    _vars = [x for x in df.columns if registry.is_var(x)]
+    found = df[_vars].notna().groupby(df['TYPE']).any()
+    for proc, row in found.iterrows():
+        registry.learn_proctype(proc, row.index[row])
+
+
+def load_cached_data(projects, proctypes, max_age=None):
+    # Read-through load for reports. Uses cached redcaps that are younger
+    # than max_age (a timedelta) and exports the others. Exports are saved
+    # to the report cache, the selection in statsdata.pkl and the redcap
+    # cache of the dashboard are only read so this does not change what
+    # the dashboard is showing.
+    logging.info(f'loading cached stats data:max_age={max_age}')
+    return get_data(projects, proctypes, max_age=max_age, report=True)
+
+
+def is_cached(filename, max_age=None):
+    if not os.path.exists(filename):
+        return False
+
+    if max_age is None:
+        return True
+
+    # Check age of the file
+    modified = datetime.fromtimestamp(os.path.getmtime(filename))
+    return (datetime.now() - modified) <= max_age
+
+
+def read_selection(filename, projects, proctypes):
+    # Returns the combined data if it was built from the same redcaps and none
+    # of those have been updated since, otherwise None
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        selection = pd.read_pickle(filename)
+        names = selection['redcaps']
+        selection['subjects']
+        selection['version']
+    except Exception as err:
+        logging.debug(f'cannot use selection file:{filename}:{err}')
+        return None
+
+    redcaps = get_stats_redcaps(projects, proctypes)
+    if names != [n for n, k in redcaps]:
+        logging.debug('selection changed')
+        return None
+
+    saved = os.path.getmtime(filename)
+    for n in names:
+        _file = get_redcap_filename(n)
+        if not os.path.exists(_file) or os.path.getmtime(_file) > saved:
+            logging.debug(f'redcap cache changed:{n}')
+            return None
+
+    return selection
 
-    logging.info('reading data from file:{}'.format(filename))
-    return read_data(filename)
+
+def save_selection(selection, filename):
+    utils.save_pickle(selection, filename)
 
 
 def get_xnat_data(xnat, project_filter):
@@ -111,60 +230,124 @@ def read_data(filename):
 
 def save_data(df, filename):
     # save to cache
-    df.to_pickle(filename)
+    utils.save_pickle(df, filename)
 
 
-def get_data(projects, proctypes):
-    # Load that data
-    df = load_stats_data(projects, proctypes)
+def get_data(projects, proctypes, refresh=False, max_age=None, report=False):
+    # Load that data, already merged with XNAT to get SITE, SESSTYPE
+    df = load_stats_data(
+        projects, proctypes, refresh=refresh, max_age=max_age, report=report)
     if df.empty:
         return df
 
-    # Merge in XNAT data to get SITE, SESSTYPE
     projects = list(df.PROJECT.unique())
-    if projects:
-        # Merge in xnat information to get SITE and SESSTYPE
-        logging.debug('merging in xnat data for projects')
-        with dax.XnatUtils.get_interface() as xnat:
-            dfp = get_xnat_data(xnat, projects)
-
-        # Merge by session to get SITE and SESSTYPE
-        _cols = ['SESSION', 'SUBJECT', 'SESSTYPE', 'SITE']
-        df = df.merge(dfp[_cols], on='SESSION', how='left')
 
+    # Clinical data is cached separately, indexed by subject and session type
     logging.info('loading demographic data')
-    _df = load_demographic_data(projects)
-    df = pd.merge(
-        df,
-        _df,
-        how='left',
-        left_on='SUBJECT',
-        right_index=True)
-
-    logging.info('loading madrs data')
-    _df = load_madrs_data(projects)
-    df = pd.merge(
-        df,
-        _df,
-        how='outer',
-        left_on=['SUBJECT', 'SESSTYPE'],
-        right_on=['SUBJECT', 'SESSTYPE'])
+    demog = clinical.load_demographics(projects).reset_index()
+
+    logging.info('loading clinical scores')
+    scores = clinical.load_scores(projects).reset_index()
+
+    # Share the key codes so the joins compare integers not strings
+    join.share_categories([df, demog, scores], 'SUBJECT')
+    join.share_categories([df, scores], 'SESSTYPE')
+    df = join.KeyIndex(demog, ['SUBJECT']).join(df, how='left')
+    df = join.KeyIndex(scores, ['SUBJECT', 'SESSTYPE']).join(df, how='outer')
+
+    # Back to strings for filtering and display
+    df['SUBJECT'] = df['SUBJECT'].astype(object)
+    df['SESSTYPE'] = df['SESSTYPE'].astype(object)
 
     df['SESSTYPE'] = df['SESSTYPE'].fillna('UNKNOWN')
 
+    learn_vars(df)
+
     return df
 
 
-def run_refresh(filename, projects, proctypes):
-    df = get_data(projects, proctypes)
+def run_refresh(filename, projects, proctypes, refresh=False):
+    # Only the redcaps that are not cached are exported, unless refresh
+    redcaps = get_stats_redcaps(projects, proctypes)
+    df = get_data(projects, proctypes, refresh=refresh)
 
     # Apply the var list filter here?
     #df = df[df.
     #var_list = [x for x in VAR_LIST if x in df and not pd.isnull(df[x]).all()]
 
-    save_data(df, filename)
+    # Pivot to subjects now so switching the table is just a lookup
+    # The version identifies this data for caching things computed from it
+    selection = {
+        'redcaps': [n for n, k in redcaps],
+        'version': datetime.now().strftime('%Y%m%d%H%M%S%f'),
+        'data': df,
+        'subjects': pivot_subjects(df)}
 
-    return df
+    save_selection(selection, filename)
+
+    return selection
+
+
+def pivot_subjects(df):
+    # Pivot to one row per subject with a column for each combination of
+    # var, session type and proc type. The redcap sync module does not
+    # prevent duplicates, so if a subject has more than one assessor of the
+    # same type and session type, the latest assessor wins.
+    _vars = [x for x in get_vars() if x in df.columns]
+    _keys = PIVOT_INDEX + PIVOT_COLUMNS
+    if df.empty or not _vars or [x for x in _keys if x not in df.columns]:
+        return pd.DataFrame()
+
+    # Only assessors, i.e. not the clinical data without imaging
+    df = df[df.TYPE.notna()].copy()
+
+    # Sort so the latest is last
+    _sort = [x for x in ['DATE', 'assessor_label'] if x in df.columns]
+    df = df.sort_values(_sort, na_position='first', kind='stable')
+
+    # Blank the keys so missing values are not dropped from the index
+    df[_keys] = df[_keys].fillna('')
+    df = df.drop_duplicates(subset=_keys, keep='last')
+
+    # Make the wide table with columns indexed by var, sesstype, proctype
+    dfp = df.set_index(_keys)[_vars].unstack(PIVOT_COLUMNS)
+    dfp.columns.names = ['var'] + PIVOT_COLUMNS
+    dfp = dfp.dropna(axis=1, how='all')
+
+    return dfp
+
+
+def select_subjects(dfp, projects, proctypes, sesstypes):
+    # Filter the subject pivot and flatten the columns to one level
+    if dfp.empty:
+        return pd.DataFrame()
+
+    if projects:
+        dfp = dfp[dfp.index.get_level_values('PROJECT').isin(projects)]
+
+    _sesstypes = dfp.columns.get_level_values('SESSTYPE')
+    _proctypes = dfp.columns.get_level_values('TYPE')
+    _mask = _proctypes.isin(proctypes or [])
+    if sesstypes:
+        _mask = _mask & _sesstypes.isin(sesstypes)
+
+    dfp = dfp.loc[:, _mask]
+    dfp = dfp.dropna(axis=1, how='all').dropna(axis=0, how='all')
+
+    # Prefix with sesstype and proctype only when needed to disambiguate
+    _levels = ['var']
+    if dfp.columns.get_level_values('SESSTYPE').nunique() > 1:
+        _levels.append('SESSTYPE')
+    if dfp.columns.get_level_values('TYPE').nunique() > 1:
+        _levels.append('TYPE')
+
+    # Concatenate column levels to get one level with delimiter
+    dfp.columns = ['_'.join(reversed(
+        [str(t[dfp.columns.names.index(x)]) for x in _levels]))
+        for t in dfp.columns]
+
+    # Clear the index so all columns are named
+    return dfp.reset_index()
 
 
 def parse_redcap_name(name):
@@ -173,14 +356,56 @@ def parse_redcap_name(name):
     return (proj, proc, res)
 
 
+def get_export_fields(field_names):
+    # Map the columns we keep back to the source field names in redcap
+    _keep = registry.get_var_set() | registry.get_static_set()
+    _rename = registry.get_stats_rename()
+    fields = [k for k, v in _rename.items() if v in _keep]
+
+    # wml is renamed for NIC after export
+    fields.append('wml_volume')
+
+    # Always include identifiers
+    fields += [x for x in STATS_ID_FIELDS if x not in fields]
+    fields += [x for x in static_columns() if x not in fields]
+
+    # Only request fields this redcap has
+    field_names = set(field_names)
+    return [x for x in fields if x in field_names]
+
+
 def load_redcap_stats(api_url, api_key):
     # Load the redcap project, lazy for speed
     _rc = redcap.Project(api_url, api_key)
 
+    # Request only the fields we will keep, falls back to everything if
+    # none of the stats fields are found in this redcap
+    _fields = []
+    try:
+        _fields = get_export_fields(_rc.field_names)
+    except Exception as err:
+        logging.debug(f'failed to get field names:{err}')
+
+    if not [x for x in _fields if x not in STATS_ID_FIELDS]:
+        logging.debug('no matching stats fields, exporting all fields')
+        _fields = None
+    elif _rc.def_field not in _fields:
+        _fields = [_rc.def_field] + _fields
+
     # Load the data, specify index since we loaded lazy
-    _df = _rc.export_records(
-        format_type='df',
-        df_kwargs={'index_col': 'record_id'})
+    try:
+        _df = _rc.export_records(
+            format_type='df',
+            fields=_fields,
+            df_kwargs={'index_col': 'record_id'})
+    except redcap.RedcapError as err:
+        if not _fields:
+            raise
+
+        logging.warning(f'failed to export fields, exporting all:{err}')
+        _df = _rc.export_records(
+            format_type='df',
+            df_kwargs={'index_col': 'record_id'})
 
     if 'wml_volume' in _df:
         # rename wml for NIC
@@ -189,11 +414,17 @@ def load_redcap_stats(api_url, api_key):
     return _df
 
 
-def load_stats_data(projects, proctypes):
-    #df = pd.DataFrame(columns=static_columns())
-    df = pd.DataFrame()
+def load_redcap_timed(name, api_url, api_key):
+    # Export a single stats redcap and report how long it took
+    start = time.time()
+    df = load_redcap_stats(api_url, api_key)
+    duration = time.time() - start
+    logging.info(f'loaded redcap:{name}:{len(df)} records:{duration:.1f} secs')
+    return df
 
-    logging.debug('loading stats data')
+
+def get_stats_redcaps(projects, proctypes):
+    redcaps = []
 
     with open(shared.KEYFILE) as f:
         for line in f:
@@ -221,26 +452,126 @@ def load_stats_data(projects, proctypes):
                 # Filter based on selected projects, nothing yields nothing
                 continue
 
+            redcaps.append((n, k))
+
+    return redcaps
+
+
+def export_stats_redcaps(redcaps):
+    # Export each redcap concurrently, returns a dict of name to DataFrame.
+    # A redcap that fails to export is logged and left out of the results so
+    # it does not take down the others.
+    results = {}
+
+    if not redcaps:
+        return results
+
+    start = time.time()
+    workers = min(MAX_EXPORT_WORKERS, len(redcaps))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for n, k in redcaps:
             logging.info(f'loading redcap:{n}')
+            _future = executor.submit(load_redcap_timed, n, shared.API_URL, k)
+            futures[_future] = n
+
+        for _future in as_completed(futures):
+            n = futures[_future]
             try:
-                cur_df = load_redcap_stats(shared.API_URL, k)
-                df = pd.concat([df, cur_df], ignore_index=True, sort=False)
+                results[n] = _future.result()
             except Exception as err:
                 logging.error(f'error exporting redcap:{n}:{err}')
                 import traceback
                 traceback.print_exc()
                 continue
 
+    duration = time.time() - start
+    logging.info(f'exported {len(results)} of {len(redcaps)} redcaps:{duration:.1f} secs')
+
+    return results
+
+
+def transform_stats(df):
     # Rename columns
-    df.rename(columns=STATS_RENAME, inplace=True)
+    df = df.rename(columns=registry.get_stats_rename())
 
     # Filter out columns we don't want by keeping intersection
-    _static = static_columns()
-    _var = get_vars()
+    _static = registry.get_static_set()
+    _var = registry.get_var_set()
     _keep = df.columns
-    _keep = [x for x in _keep if (x in _var or x in _static)]
+    _keep = [x for x in _keep if (x in _var or x in _static or x == 'DATE')]
     df = df[_keep]
 
+    return df.reset_index(drop=True)
+
+
+def update_stats_cache(redcaps, report=False):
+    # Export the redcaps, merge each with XNAT and save each to its own file
+    results = export_stats_redcaps(redcaps)
+    results = {n: transform_stats(df) for n, df in results.items()}
+
+    # Merge in XNAT data to get SITE, SESSTYPE with one query for all
+    projects = set()
+    for df in results.values():
+        if 'PROJECT' in df:
+            projects.update(df.PROJECT.dropna().unique())
+
+    if projects:
+        logging.debug('merging in xnat data for projects')
+        with dax.XnatUtils.get_interface() as xnat:
+            dfp = get_xnat_data(xnat, sorted(projects))
+
+        # Merge by session to get SITE and SESSTYPE, index the sessions
+        # once for all the redcaps
+        _cols = ['SESSION', 'SUBJECT', 'SESSTYPE', 'SITE']
+        sessions = join.KeyIndex(dfp[_cols], ['SESSION'])
+        for n, df in results.items():
+            if 'SESSION' in df:
+                results[n] = sessions.join(df)
+
+    for n, df in results.items():
+        filename = get_redcap_filename(n, report=report)
+        logging.info(f'saving redcap cache:{filename}')
+        save_data(df, filename)
+
+    return results
+
+
+def load_stats_data(
+    projects, proctypes, refresh=False, max_age=None, report=False
+):
+    frames = {}
+    missing = []
+
+    logging.debug('loading stats data')
+
+    # Use the cached redcaps and find what's missing or too old, reports
+    # can also use their own cache
+    redcaps = get_stats_redcaps(projects, proctypes)
+    for n, k in redcaps:
+        filenames = [get_redcap_filename(n)]
+        if report:
+            filenames.append(get_redcap_filename(n, report=True))
+
+        for filename in filenames:
+            if not refresh and is_cached(filename, max_age):
+                logging.debug(f'reading redcap cache:{filename}')
+                frames[n] = read_data(filename)
+                break
+        else:
+            missing.append((n, k))
+
+    # Export only the missing redcaps
+    if missing:
+        frames.update(update_stats_cache(missing, report=report))
+
+    # Concatenate once in keyfile order
+    frames = [frames[n] for n, k in redcaps if n in frames]
+    if frames:
+        df = pd.concat(frames, ignore_index=True, sort=False)
+    else:
+        df = pd.DataFrame()
+
     # return the stats data
     logging.info('loaded {} stats'.format(len(df)))
     return df
@@ -286,113 +617,6 @@ def filter_data(df, projects, proctypes, timeframe, sesstypes):
     return df
 
 
-def load_madrs_data(projects):
-    df = pd.DataFrame(columns=['SUBJECT', 'ma_tot', 'SESSTYPE'])
-
-    if 'DepMIND2' in projects:
-        k = utils.get_projectkeybyname('DepMIND2 primary', shared.KEYFILE)
-        _fields = ['record_id', 'ma_tot']
-        _map = {
-            'week_0baseline_arm_1': 'Baseline',
-            'week_6_arm_1': 'Week6',
-            'week_12_arm_1': 'Week12',
-            'week_3_arm_1': 'Week3',
-            'week_9_arm_1': 'Week9',
-        }
-        _events = _map.keys()
-
-        # Connect to the redcap project
-        logging.info('connecting to redcap')
-        _proj = redcap.Project(shared.API_URL, k)
-
-        # Load secondary ID
-        def_field = _proj.def_field
-        sec_field = _proj.export_project_info()['secondary_unique_field']
-        rec = _proj.export_records(
-            fields=[def_field, sec_field],
-            format_type='df')
-        rec.dropna(subset=[sec_field], inplace=True)
-        rec[sec_field] = rec[sec_field].astype(int).astype(str)
-        rec = rec.reset_index()
-        rec = rec.drop('redcap_event_name', axis=1)
-
-        # Load madrs data
-        df = _proj.export_records(
-            raw_or_label='raw',
-            format_type='df',
-            fields=_fields,
-            events=_events)
-
-        # Merge in subject_number (probably could do this with a column map)
-        df = df.reset_index()
-        df = pd.merge(
-            df,
-            rec,
-            how='left',
-            left_on='record_id',
-            right_on='record_id',
-            sort=True)
-
-        # Rename for consistency with other studies
-        df.rename(columns={'subject_number': 'SUBJECT'}, inplace=True)
-
-        # Map redcap event to xnat session type
-        df['SESSTYPE'] = df['redcap_event_name'].map(_map)
-        df = df.drop('redcap_event_name', axis=1)
-
-        # Remove missing data
-        df = df.dropna()
-
-        # Force int format
-        df['ma_tot'] = df['ma_tot'].astype(int)
-
-        df = df.sort_values('SUBJECT')
-
-    return df
-
-
-def load_demographic_data(projects):
-    df = pd.DataFrame(columns=['SUBJECT', 'AGE', 'SEX', 'DEPRESS'])
-
-    if 'DepMIND2' in projects:
-        # Load the records from redcap
-        k = utils.get_projectkeybyname("DepMIND2 primary", shared.KEYFILE)
-        _proj = redcap.Project(shared.API_URL, k)
-        _fields = [
-            'record_id',
-            'subject_number',
-            'age',
-            'sex_xcount']
-        _events = ['screening_arm_1']
-        df = _proj.export_records(
-            raw_or_label='label',
-            format_type='df',
-            fields=_fields,
-            events=_events)
-
-        # All DM2 are depressed
-        df['DEPRESS'] = '1'
-
-        # Transform for dashboard data
-        _rename = {
-            'subject_number': 'SUBJECT',
-            'age': 'AGE',
-            'sex_xcount': 'SEX'}
-        df = df.rename(columns=_rename)
-
-    # A bit of cleanup
-    df = df.dropna(subset=['SUBJECT'])
-    df['SUBJECT'] = df['SUBJECT'].astype(int).astype(str)
-    df = df.set_index('SUBJECT', verify_integrity=True)
-
-    # Fill with blanks so we don't lose to nans
-    df['AGE'] = df['AGE'].fillna('')
-    df['SEX'] = df['SEX'].fillna('')
-    df['DEPRESS'] = df['DEPRESS'].fillna('')
-
-    return df
-
-
 def load_options(projects, proctypes):
     # Only filter proctypes if projects are selected
     # Only filter projects by proctypes selected
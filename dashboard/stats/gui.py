@@ -1,6 +1,5 @@
 import logging
 
-import pandas as pd
 import plotly
 import plotly.graph_objs as go
 import plotly.subplots
@@ -11,13 +10,22 @@ import dash
 from app import app
 import utils
 import stats.data as data
+import stats.summary as summary
 
 
-def get_graph_content(df):
+# Variables per tab and how many boxplots per row in each tab
+VARS_PER_TAB = 12
+GRID_COLS = 4
+
+# Above this many points in a box, draw the box from summary statistics with
+# only the outliers as points
+MAX_BOX_POINTS = 500
+
+
+def get_graph_content(df, version=None):
     tabs_content = []
-    tab_value = 0
     box_width = 250
-    min_box_count = 4
+    box_height = 300
 
     logging.debug('get_stats_figure')
 
@@ -26,87 +34,128 @@ def get_graph_content(df):
         logging.debug('empty data, using empty figure')
         return [plotly.subplots.make_subplots(rows=1, cols=1)]
 
-    # Filter var list to only include those that have data
-    var_list = [x for x in df.columns if not pd.isnull(df[x]).all()]
+    # Count values of every column in one pass, then filter var list to only
+    # stats variables that have data, this also helps sort by order in params
+    counts = df.notna().sum()
+    proctypes = df['TYPE'].dropna().unique() if 'TYPE' in df else None
+    var_list = data.get_variables(proctypes)
+    var_list = [x for x in var_list if counts.get(x, 0) > 0]
+
+    # Summarize the vars by site, this is cached for the version
+    site_summary = summary.get_summary(
+        df, var_list, keys=['SITE'], version=version)
+
+    # Split the vars into pages, each page is a tab with a grid of boxplots
+    for tab_value, start in enumerate(range(0, len(var_list), VARS_PER_TAB)):
+        page_vars = var_list[start:start + VARS_PER_TAB]
+        fig = get_page_figure(
+            df, page_vars, counts, site_summary, box_width, box_height)
+
+        # Build the tab
+        # We set the graph to overflow and then limit the size to 1000px,
+        # this makes the graph stay in a scrollable section
+        if len(var_list) <= VARS_PER_TAB:
+            label = 'ALL'
+        else:
+            label = '{}-{}'.format(start + 1, start + len(page_vars))
+
+        graph = html.Div(
+            dcc.Graph(figure=fig, style={'overflow': 'scroll'}),
+            style={'width': '1000px'})
+
+        tab = dcc.Tab(label=label, value=str(tab_value), children=[graph])
+
+        # Append the tab
+        tabs_content.append(tab)
 
-    # Filter var list to only stats variables, this also helps sort
-    # by order in params yaml
-    var_list = [x for x in data.get_variables() if x in var_list]
+    if not tabs_content:
+        logging.debug('no vars with data, using empty figure')
+        return [plotly.subplots.make_subplots(rows=1, cols=1)]
 
-    # Determine how many boxplots we're making, depends on how many vars, use
-    # minimum so graph doesn't get too small
-    box_count = len(var_list)
-    if box_count < min_box_count:
-        box_count = min_box_count
+    # Return the tabs
+    return tabs_content
 
-    graph_width = box_width * box_count
 
-    # Horizontal spacing cannot be greater than (1 / (cols - 1))
-    #hspacing = 1 / (box_count * 2)
-    hspacing = 1 / (box_count * 4)
+def get_page_figure(df, var_list, counts, site_summary, box_width, box_height):
+    # Make a grid with a box plot for each var
+    cols = GRID_COLS
+    rows = ((len(var_list) - 1) // cols) + 1
 
-    # Make the figure with 1 row and a column for each var we are plotting
+    # Spacing cannot be greater than (1 / (cols - 1))
     fig = plotly.subplots.make_subplots(
-        rows=1,
-        cols=box_count,
-        horizontal_spacing=hspacing,
+        rows=rows,
+        cols=cols,
+        horizontal_spacing=1 / (cols * 4),
+        vertical_spacing=0.3 / rows,
         subplot_titles=var_list)
 
-    # box plots
-    # each proctype has specific set of fields to plot,
-    # TODO: we need a dictionary listing them
-    # then we just do the boxplots for the chosen proctypes (and maybe scan
-    # types?, how did we do that for fmri scan type?)
+    # Points per box depends on how many sites split the values
+    site_count = max(df['SITE'].nunique(), 1)
+
+    # Vars with no numeric values have no summary
+    summary_vars = set(site_summary.index.get_level_values('VAR'))
 
     # Add traces to figure
     for i, var in enumerate(var_list):
-        _row = 1
-        _col = i + 1
-        # Create boxplot for this var and add to figure
-        fig.append_trace(
-            go.Box(
-                y=df[var],
-                x=df['SITE'],
-                boxpoints='all',
-                text=df['assessor_label']),
-            _row,
-            _col)
+        _row = (i // cols) + 1
+        _col = (i % cols) + 1
 
-        if var.startswith('con_') or var.startswith('inc_'):
-            fig.update_yaxes(range=[-1, 1], autorange=False)
+        if counts[var] / site_count > MAX_BOX_POINTS:
+            # Too many points to draw, use the summary
+            if var not in summary_vars:
+                # Nothing to draw, leave the box empty
+                continue
+
+            for trace in get_summary_traces(site_summary.loc[var]):
+                fig.append_trace(trace, _row, _col)
         else:
-            fig.update_yaxes(autorange=True)
-            pass
+            # Create boxplot for this var with all points
+            fig.append_trace(
+                go.Box(
+                    y=df[var],
+                    x=df['SITE'],
+                    boxpoints='all',
+                    text=df['assessor_label']),
+                _row,
+                _col)
 
-    # Move the subtitles to bottom instead of top of each subplot
-    if len(df['SITE'].unique()) < 4:
-        for i in range(len(fig.layout.annotations)):
-            fig.layout.annotations[i].update(y=-.15)
-        # , font={'size': 18})
+        if var.startswith('con_') or var.startswith('inc_'):
+            fig.update_yaxes(
+                range=[-1, 1], autorange=False, row=_row, col=_col)
 
     # Customize figure to hide legend and fit the graph
     fig.update_layout(
         showlegend=False,
         autosize=False,
-        width=graph_width,
+        width=box_width * cols,
+        height=box_height * rows,
         margin=dict(l=20, r=40, t=40, b=80, pad=0))
 
-    # Build the tab
-    # We set the graph to overflow and then limit the size to 1000px, this
-    # makes the graph stay in a scrollable section
-    label = 'ALL'
-    graph = html.Div(
-        dcc.Graph(figure=fig, style={'overflow': 'scroll'}),
-        style={'width': '1000px'})
+    return fig
 
-    tab = dcc.Tab(label=label, value=str(tab_value), children=[graph])
-    tab_value += 1
 
-    # Append the tab
-    tabs_content.append(tab)
+def get_summary_traces(dfs):
+    # Boxes from the precomputed statistics, indexed by site
+    sites = list(dfs.index)
+    box = go.Box(
+        x=sites,
+        q1=dfs['q1'],
+        median=dfs['median'],
+        q3=dfs['q3'],
+        mean=dfs['mean'],
+        lowerfence=dfs['lowerfence'],
+        upperfence=dfs['upperfence'],
+        boxpoints=False)
 
-    # Return the tabs
-    return tabs_content
+    # Points for only the outliers
+    outliers = go.Scatter(
+        x=[s for s, v in zip(sites, dfs['outliers']) for _ in v],
+        y=[x for v in dfs['outliers'] for x in v],
+        text=[x for v in dfs['outlier_labels'] for x in v],
+        mode='markers',
+        marker={'size': 4})
+
+    return [box, outliers]
 
 
 def get_content():
@@ -209,6 +258,10 @@ def load_stats(projects, proctypes, refresh=False):
     return data.load_data(projects, proctypes, refresh=refresh)
 
 
+def load_selection(projects, proctypes, refresh=False):
+    return data.load_selection(projects, proctypes, refresh=refresh)
+
+
 def was_triggered(callback_ctx, button_id):
     result = (
         callback_ctx.triggered
@@ -253,7 +306,8 @@ def update_stats(
         refresh = True
 
     # Load selected data with refresh if requested
-    df = load_stats(selected_proj, selected_proc, refresh=refresh)
+    selection = load_selection(selected_proj, selected_proc, refresh=refresh)
+    df = selection['data']
 
     # Get options based on redcdap keys file
     proj_options, proc_options = data.load_options(selected_proj, selected_proc)
@@ -276,53 +330,37 @@ def update_stats(
         selected_time,
         selected_sess)
 
-    # Get the graph content in tabs (currently only one tab)
-    tabs = get_graph_content(df)
+    # Get the graph content in tabs, summaries are cached for this data
+    # with these filters
+    version = (
+        selection['version'],
+        tuple(sorted(selected_proj or [])),
+        tuple(sorted(selected_proc or [])),
+        selected_time,
+        tuple(sorted(selected_sess or [])))
+    tabs = get_graph_content(df, version=version)
 
-    # TODO: handle multiple of same type for a subject?
     if selected_pivot == 'subj':
-        try:
-            # Pivot to one row per subject
-
-            _index = ['SUBJECT', 'PROJECT', 'AGE', 'SEX', 'DEPRESS', 'SITE']
-
-            _vars = data.get_vars()
-
-            _vars = [x for x in df.columns if (
-                x in _vars and not pd.isnull(df[x]).all())]
-
-            _cols = []
-            if len(df.SESSTYPE.unique()) > 1:
-                # Multiple session types, need prefix to disambiguate
-                _cols += ['SESSTYPE']
-            if len(df.TYPE.unique()) > 1:
-                # Multiple processing types, need prefix to disambiguate
-                _cols += ['TYPE']
-
-            # Drop any duplicates found b/c redcap sync module does not prevent
-            df = df.drop_duplicates()
-
-            # Make the pivot table based on _index, _cols, _vars
-            dfp = df.pivot(index=_index, columns=_cols, values=_vars)
-
-            # Concatenate column levels to get one level with delimiter
-            dfp.columns = ['_'.join(reversed(t)) for t in dfp.columns]
+        # Pivot to one row per subject, use the pivot made at refresh unless
+        # filtering by time, duplicates are resolved by latest assessor
+        if selected_time in ['1day', '7day', '30day', '365day']:
+            dfp = data.pivot_subjects(df)
+        else:
+            dfp = selection['subjects']
 
-            # Clear the index so all columns are named
-            dfp = dfp.reset_index()
+        dfp = data.select_subjects(
+            dfp, selected_proj, selected_proc, selected_sess)
 
-            columns = utils.make_columns(dfp.columns)
-            records = dfp.to_dict('records')
-        except ValueError:
-            logging.warn('failed to pivot, duplicates')
+        columns = utils.make_columns(dfp.columns)
+        records = dfp.to_dict('records')
     else:
         # Keep as to one row per assessor
 
         # Determine columns to be included in the table
         selected_cols = list(data.static_columns())
-        _vars = data.get_vars()
-        _vars = [x for x in df.columns if (
-            x in _vars and not pd.isnull(df[x]).all())]
+        _vars = set(data.get_variables(selected_proc))
+        _notnull = df.notna().any()
+        _vars = [x for x in df.columns if (x in _vars and _notnull[x])]
         selected_cols.extend(_vars)
 
         # Get the table data as one row per assessor
@@ -0,0 +1,121 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+# Joins on string keys such as SESSION and SUBJECT. The right side is indexed
+# once by converting its keys to categorical codes and sorting, then each join
+# converts the left keys to the same categories and finds the rows by binary
+# search on integers. When the left keys are already categoricals with the
+# same categories, e.g. by using share_categories(), no strings are compared.
+# Unlike pd.merge, columns on both sides are not kept with suffixes, the
+# values from the index replace the ones in the left frame.
+
+
+def share_categories(frames, key):
+    # Convert the key column in each frame to a categorical with the same
+    # categories, returns the categories
+    values = [df[key] for df in frames if key in df]
+    categories = pd.Index(pd.concat(values, ignore_index=True).dropna().unique())
+    for df in frames:
+        if key in df:
+            df[key] = pd.Categorical(df[key], categories=categories)
+
+    return categories
+
+
+def get_codes(values, categories):
+    # Codes of values in categories, -1 where missing or not found
+    if isinstance(values.dtype, pd.CategoricalDtype) and \
+            values.cat.categories.equals(categories):
+        return values.cat.codes.to_numpy()
+
+    return pd.Categorical(values, categories=categories).codes
+
+
+class KeyIndex(object):
+    def __init__(self, df, keys, categories=None):
+        self.keys = list(keys)
+        self.columns = [x for x in df.columns if x not in self.keys]
+
+        # Categories for each key, shared with every frame we join
+        self.categories = []
+        for k in self.keys:
+            if categories and k in categories:
+                self.categories.append(categories[k])
+            elif isinstance(df[k].dtype, pd.CategoricalDtype):
+                self.categories.append(df[k].cat.categories)
+            else:
+                self.categories.append(pd.Index(pd.unique(df[k].dropna())))
+
+        # Sort by the combined code so we can search it
+        codes = self.encode(df)
+        order = np.argsort(codes, kind='stable')
+        self.codes = codes[order]
+        self.df = df.iloc[order].reset_index(drop=True)
+
+        # Rows with missing keys never match, same as a merge would not
+        # match them to a key that exists
+        _valid = self.codes[self.codes >= 0]
+        self.unique = not (len(_valid) > 1 and (np.diff(_valid) == 0).any())
+
+    def encode(self, df):
+        # Combine the codes of each key into one integer, -1 if any key is
+        # missing or not in the categories
+        combined = np.zeros(len(df), dtype='int64')
+        missing = np.zeros(len(df), dtype=bool)
+        for k, cats in zip(self.keys, self.categories):
+            codes = get_codes(df[k], cats)
+            missing |= (codes < 0)
+            combined = combined * (len(cats) + 1) + codes
+
+        combined[missing] = -1
+        return combined
+
+    def lookup(self, df):
+        # Position of the matching row for each row of df, -1 if none
+        codes = self.encode(df)
+        if len(self.codes) == 0:
+            return np.full(len(df), -1), codes
+
+        pos = np.searchsorted(self.codes, codes)
+        pos = np.minimum(pos, len(self.codes) - 1)
+        found = (codes >= 0) & (self.codes[pos] == codes)
+        return np.where(found, pos, -1), codes
+
+    def join(self, df, how='left'):
+        # Returns df with the columns of the index added, same rows as
+        # pd.merge(df, index, how=how, on=keys) but not in the same order.
+        # Columns in both that are not keys are dropped from df first, so
+        # the values come from the index instead of getting suffixes.
+        overlap = [x for x in self.columns if x in df.columns]
+        if overlap:
+            logging.debug(f'replacing columns from index:{overlap}')
+            df = df.drop(columns=overlap)
+
+        if not self.unique or how not in ['left', 'outer']:
+            # Duplicate keys can multiply rows, let pandas handle it
+            logging.debug('duplicate keys, using merge')
+            return pd.merge(df, self.df, how=how, on=self.keys)
+
+        pos, codes = self.lookup(df)
+        result = df.copy()
+        for c in self.columns:
+            values = self.df[c].take(np.maximum(pos, 0)) if len(self.df) else \
+                pd.Series(np.nan, index=range(len(df)), dtype=object)
+            values = values.reset_index(drop=True)
+            values.index = result.index
+            result[c] = values.where(pos >= 0)
+
+        if how == 'outer':
+            # Append the rows from the index that did not match
+            matched = np.zeros(len(self.codes), dtype=bool)
+            matched[pos[pos >= 0]] = True
+            extra = self.df[~matched]
+            if not extra.empty:
+                result = pd.concat(
+                    [result, extra], ignore_index=True, sort=False)
+
+        return result
+
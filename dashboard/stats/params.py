@@ -1,8 +1,11 @@
+import logging
 import os
+import threading
+
 import yaml
 
 
-# TODO: refactor this so we link vars to the type and allow filtering somewhere
+# Default settings, use registry below to get the current settings
 
 VAR_LIST = [
     'ma_tot',
@@ -223,21 +226,167 @@ STATIC_COLUMNS = [
     'SESSTYPE']
 
 
-# check for a statsparams.yaml file to override var lists
-try:
-    # Read inputs yaml as dictionary
-    PARAMSFILE = os.path.join(os.path.expanduser("~"), 'statsparams.yaml')
-    with open(PARAMSFILE, 'rt') as file:
-        print('loading stats params from file')
-        params_data = yaml.load(file, yaml.SafeLoader)
+# Vars for each proc type, used to limit the vars to the selected proc types.
+# This can be set in the params file, otherwise it is learned from the data
+# as it is loaded. Proc types not found use all vars. Clinical score vars are
+# always included.
+PROCTYPE_VARS = {}
+
+
+# Clinical data to merge with stats for each project. Subjects are matched
+# by the secondary ID of the primary redcap. demographics are from one event
+# and values are set for all subjects. scores map each redcap event to an
+# XNAT session type.
+CLINICAL_PROJECTS = {
+    'DepMIND2': {
+        'primary': 'DepMIND2 primary',
+        'demographics': {
+            'events': ['screening_arm_1'],
+            'fields': {'age': 'AGE', 'sex_xcount': 'SEX'},
+            'values': {'DEPRESS': '1'},
+        },
+        'scores': {
+            'fields': ['ma_tot'],
+            'events': {
+                'week_0baseline_arm_1': 'Baseline',
+                'week_6_arm_1': 'Week6',
+                'week_12_arm_1': 'Week12',
+                'week_3_arm_1': 'Week3',
+                'week_9_arm_1': 'Week9',
+            },
+        },
+    },
+}
+
+
+# The params file can override VAR_LIST, STATS_RENAME, PROCTYPE_VARS and
+# CLINICAL_PROJECTS
+PARAMSFILE = os.path.join(os.path.expanduser("~"), 'statsparams.yaml')
+
+
+class VarRegistry(object):
+    # Loads the params file on first use and again whenever it changes
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = None
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.learned = {}
+        self._set_params({})
+
+    def _set_params(self, params):
+        self.var_list = list(params.get('VAR_LIST', VAR_LIST))
+        self.var_set = set(self.var_list)
+        self.var_index = {v: i for i, v in enumerate(self.var_list)}
+        self.stats_rename = dict(params.get('STATS_RENAME', STATS_RENAME))
+        self.static_set = set(STATIC_COLUMNS)
+        self.proctype_vars = {
+            k: set(v) for k, v in params.get(
+                'PROCTYPE_VARS', PROCTYPE_VARS).items()}
+        self.clinical = dict(params.get(
+            'CLINICAL_PROJECTS', CLINICAL_PROJECTS))
+
+    def _check(self):
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except EnvironmentError:
+            mtime = None
+
+        if self.loaded and mtime == self.mtime:
+            return
+
+        with self.lock:
+            if self.loaded and mtime == self.mtime:
+                return
+
+            params = {}
+            if mtime is None:
+                logging.info('params file not found, using defaults')
+            else:
+                # Read inputs yaml as dictionary
+                logging.info(f'loading stats params from file:{self.filename}')
+                try:
+                    with open(self.filename, 'rt') as file:
+                        params = yaml.load(file, yaml.SafeLoader) or {}
+                except (EnvironmentError, yaml.YAMLError) as err:
+                    logging.error(f'failed to load params file:{err}')
+
+            for k in [
+                'VAR_LIST', 'STATS_RENAME', 'PROCTYPE_VARS',
+                'CLINICAL_PROJECTS'
+            ]:
+                if k in params:
+                    logging.info(f'setting {k}')
+
+            self._set_params(params)
+            self.mtime = mtime
+            self.loaded = True
+
+    def get_var_set(self):
+        self._check()
+        return self.var_set
+
+    def get_stats_rename(self):
+        self._check()
+        return self.stats_rename
+
+    def get_static_set(self):
+        self._check()
+        return self.static_set
+
+    def get_clinical_projects(self):
+        self._check()
+        return self.clinical
+
+    def is_var(self, name):
+        self._check()
+        return name in self.var_set
+
+    def get_clinical_vars(self):
+        # Score vars from the clinical data, these are merged with every
+        # proc type so they are not learned
+        self._check()
+        found = set()
+        for config in self.clinical.values():
+            found.update(config.get('scores', {}).get('fields', []))
+
+        return found & self.var_set
+
+    def learn_proctype(self, proctype, columns):
+        # Record which vars were found for a proc type
+        self._check()
+        found = self.var_set.intersection(columns)
+        with self.lock:
+            self.learned.setdefault(proctype, set()).update(found)
+
+    def get_proctype_vars(self, proctype):
+        # Vars for this proc type, None if we don't know
+        self._check()
+        if proctype in self.proctype_vars:
+            return self.proctype_vars[proctype]
+
+        # Copy the learned set so other threads can keep adding to it
+        with self.lock:
+            found = self.learned.get(proctype, None)
+            return None if found is None else set(found)
+
+    def get_vars_for(self, proctypes=None):
+        # Vars in order of the var list, limited to the proc types if
+        # we know the vars for all of them
+        self._check()
+        if not proctypes:
+            return self.var_list
+
+        found = self.get_clinical_vars()
+        for proctype in proctypes:
+            _vars = self.get_proctype_vars(proctype)
+            if _vars is None:
+                return self.var_list
+
+            found.update(_vars)
 
-        if 'VAR_LIST' in params_data:
-            print('setting VAR_LIST')
-            VAR_LIST = params_data['VAR_LIST']
+        return sorted(found & self.var_set, key=self.var_index.get)
 
-        if 'STATS_RENAME' in params_data:
-            print('setting STATS_RENAME')
-            STATS_RENAME = params_data['STATS_RENAME']
 
-except EnvironmentError:
-    print('params file not found, not loading')
+registry = VarRegistry(PARAMSFILE)
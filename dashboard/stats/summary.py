@@ -0,0 +1,105 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+# Summary statistics for stats variables, computed here so graphs can draw
+# boxes from the summaries instead of sending every value to the browser.
+# Quartiles use linear interpolation and fences are the furthest values
+# within 1.5 IQR of the quartiles, same as plotly does for boxes.
+
+
+# Default keys we summarize each variable by
+SUMMARY_KEYS = ['SITE', 'SESSTYPE', 'PROJECT']
+
+SUMMARY_COLUMNS = [
+    'count', 'mean', 'q1', 'median', 'q3', 'lowerfence', 'upperfence',
+    'outliers', 'outlier_labels']
+
+# How many summaries we keep in memory
+MAX_CACHED = 32
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_summary(df, var_list, keys=SUMMARY_KEYS, version=None):
+    # Returns the summary, cached when a version is given. The version must
+    # change whenever the data in df changes.
+    if version is None:
+        return summarize(df, var_list, keys)
+
+    cache_key = (version, tuple(var_list), tuple(keys))
+    with _cache_lock:
+        if cache_key in _cache:
+            logging.debug('using cached summary')
+            _cache.move_to_end(cache_key)
+            return _cache[cache_key]
+
+    # Summarize outside the lock so other callbacks are not held up
+    dfs = summarize(df, var_list, keys)
+
+    with _cache_lock:
+        _cache[cache_key] = dfs
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+
+    return dfs
+
+
+def summarize(df, var_list, keys=SUMMARY_KEYS):
+    # Returns DataFrame indexed by VAR and keys with a column for each
+    # statistic, outliers are lists of values with matching assessor labels
+    _by = ['VAR'] + list(keys)
+    var_list = [x for x in var_list if x in df.columns]
+
+    if df.empty or not var_list:
+        return pd.DataFrame(
+            columns=SUMMARY_COLUMNS,
+            index=pd.MultiIndex.from_tuples([], names=_by))
+
+    # Make it long with one row per value
+    df = df.copy()
+    if 'assessor_label' not in df:
+        df['assessor_label'] = ''
+
+    df[keys] = df[keys].fillna('UNKNOWN')
+    dfl = df[list(keys) + ['assessor_label'] + var_list].melt(
+        id_vars=list(keys) + ['assessor_label'],
+        var_name='VAR',
+        value_name='VALUE')
+    dfl['VALUE'] = pd.to_numeric(dfl['VALUE'], errors='coerce')
+    dfl = dfl.dropna(subset=['VALUE'])
+
+    # Counts, means and quartiles for each group
+    grouped = dfl.groupby(_by)['VALUE']
+    dfs = grouped.agg(['count', 'mean'])
+    quartiles = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    dfs['q1'] = quartiles[0.25]
+    dfs['median'] = quartiles[0.5]
+    dfs['q3'] = quartiles[0.75]
+
+    # Join the limits back to the values to find the outliers
+    iqr = dfs['q3'] - dfs['q1']
+    limits = pd.DataFrame({
+        'LOWER': dfs['q1'] - 1.5 * iqr,
+        'UPPER': dfs['q3'] + 1.5 * iqr})
+    dfl = dfl.join(limits, on=_by)
+    is_outlier = (dfl.VALUE < dfl.LOWER) | (dfl.VALUE > dfl.UPPER)
+
+    # Fences are the extreme values that are not outliers
+    inside = dfl[~is_outlier].groupby(_by)['VALUE'].agg(['min', 'max'])
+    dfs['lowerfence'] = inside['min']
+    dfs['upperfence'] = inside['max']
+
+    # List the outliers so they can still be drawn as points
+    outside = dfl[is_outlier].groupby(_by)[['VALUE', 'assessor_label']].agg(
+        list)
+    dfs['outliers'] = outside['VALUE']
+    dfs['outlier_labels'] = outside['assessor_label']
+    for col in ['outliers', 'outlier_labels']:
+        dfs[col] = [x if isinstance(x, list) else [] for x in dfs[col]]
+
+    return dfs[SUMMARY_COLUMNS]
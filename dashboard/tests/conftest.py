@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The dashboard modules import each other from the dashboard directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('dax')
+pytest.importorskip('redcap')
+
+from activity import data
+
+
+def make_activity(na_position):
+    # Jobs without a time, 5 of them running, then activity in January and
+    # October sorted the way get_data() saves it
+    rows = []
+    for i in range(50):
+        rows.append({
+            'DATETIME': None,
+            'SOURCE': 'dax',
+            'STATUS': 'NPUT' if i < 5 else 'COMPLETE',
+            'DESCRIPTION': f'job{i}'})
+
+    for month in [1, 10]:
+        for day in range(1, 11):
+            rows.append({
+                'DATETIME': datetime(2026, month, day),
+                'SOURCE': 'ccmutils',
+                'STATUS': 'COMPLETE',
+                'DESCRIPTION': f'{month}-{day}'})
+
+    df = pd.DataFrame(rows)
+    df['DATETIME'] = pd.to_datetime(df['DATETIME'])
+    df = df.sort_values(
+        'DATETIME', kind='stable', na_position=na_position)
+    return df.reset_index(drop=True)
+
+
+@pytest.mark.parametrize('na_position', ['first', 'last'])
+def test_select_window_with_undated_rows(monkeypatch, na_position):
+    monkeypatch.setattr(
+        data, 'get_window_start', lambda window: datetime(2026, 8, 1))
+
+    df = data.select_window(make_activity(na_position), 'lastmonth')
+
+    # October newest first, then the running jobs, nothing from January
+    dated = df[df['DATETIME'].notna()]
+    assert list(dated['DESCRIPTION']) == [f'10-{x}' for x in range(10, 0, -1)]
+    assert sorted(df[df['DATETIME'].isna()]['DESCRIPTION']) == [
+        f'job{x}' for x in range(5)]
+    assert list(df['ID']) == list(range(15))
+
+
+def test_select_window_all_time():
+    df = data.select_window(make_activity('last'), 'ALL')
+
+    assert len(df) == 70
+    assert df['DESCRIPTION'].iloc[0] == '10-10'
+    assert df['DATETIME'].iloc[20:].isna().all()
+
+
+class EmptyProject(object):
+    # Main redcap with no activity in the window, pycap returns a frame
+    # without any columns
+    def __init__(self, url, key):
+        pass
+
+    def export_records(self, **kwargs):
+        return pd.DataFrame()
+
+
+@pytest.mark.parametrize('stored', [False, True])
+def test_sync_empty_export(monkeypatch, tmp_path, stored):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(data.redcap, 'Project', EmptyProject)
+    monkeypatch.setattr(data.utils, 'get_projectid', lambda *args: 'main')
+    monkeypatch.setattr(data.utils, 'get_projectkey', lambda *args: 'key')
+
+    if stored:
+        # Something from yesterday so we only export what's new
+        dfs = pd.DataFrame([{
+            'ID': 3,
+            'PROJECT': 'P1',
+            'STATUS': 'COMPLETE',
+            'SOURCE': 'ccmutils',
+            'DATETIME': datetime.now() - timedelta(days=1)}])
+        pd.to_pickle(
+            {'data': dfs, 'instances': {'P1': 3}},
+            data.get_redcap_filename())
+
+    df = data.sync_activity_redcap()
+
+    assert len(df) == (1 if stored else 0)
+    assert 'PROJECT' in df.columns
+    assert pd.read_pickle(data.get_redcap_filename())['instances'] == (
+        {'P1': 3} if stored else {})
@@ -0,0 +1,167 @@
+import contextlib
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('dax')
+pytest.importorskip('redcap')
+
+import utils
+from admin import audits, xnat_cache
+
+
+class Snapshot(object):
+    def __init__(self, records):
+        self.records = records
+        self.secondary_ids = None
+
+    def project_names(self):
+        return sorted(set(x['main_name'] for x in self.records))
+
+    def project_record(self, project):
+        return [x for x in self.records if x['main_name'] == project][0]
+
+
+def main_record(name, **kwargs):
+    rec = {
+        'main_name': name,
+        'main_phanproject': '',
+        'redcap_repeat_instrument': '',
+        'scanning_srcproject': '',
+        'scanning_ignore': '',
+    }
+    rec.update(kwargs)
+    return rec
+
+
+def test_hung_audit_times_out(monkeypatch, tmp_path):
+    # One project audit hangs while listing its sessions on XNAT, it should
+    # time out and the other project and the root audit should still finish
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(audits, 'AUDIT_TIMEOUT', 1)
+    monkeypatch.setattr(audits, 'AUDIT_POLL', 0.1)
+    monkeypatch.setattr(xnat_cache, 'LIST_TIMEOUT', 1)
+
+    hang = threading.Event()
+
+    @contextlib.contextmanager
+    def interface(**kwargs):
+        yield None
+
+    def session_label_list(xnat, project):
+        if project == 'HUNG':
+            hang.wait(30)
+
+        return ['A', 'B']
+
+    def session_vuiisid_list(xnat, project):
+        return ['A']
+
+    def audit_one_project(p, snapshot, started, sessions=None):
+        started[p] = time.time()
+        sessions.session_labels(p)
+        return [], 'COMPLETE'
+
+    monkeypatch.setattr(xnat_cache.XnatUtils, 'InterfaceTemp', interface)
+    monkeypatch.setattr(utils, 'session_label_list', session_label_list)
+    monkeypatch.setattr(utils, 'session_vuiisid_list', session_vuiisid_list)
+    monkeypatch.setattr(audits, 'audit_one_project', audit_one_project)
+
+    snapshot = Snapshot([
+        main_record('HUNG'),
+        main_record('OK'),
+        main_record(
+            'OK',
+            redcap_repeat_instrument='scanning',
+            scanning_srcproject='PI'),
+    ])
+
+    try:
+        start = time.time()
+        issues = audits.run_audits(None, snapshot=snapshot)
+        assert time.time() - start < 10
+    finally:
+        hang.set()
+
+    timeouts = [x for x in issues if x['type'] == 'ERROR']
+    assert [x['project'] for x in timeouts] == ['HUNG']
+    assert 'timed out' in timeouts[0]['description']
+
+    unmatched = [x for x in issues if x['type'] == 'UNMATCHED_SESSION']
+    assert [(x['project'], x['session']) for x in unmatched] == [('OK', 'B')]
+
+    durations = audits.load_durations()
+    assert dict(zip(durations.PROJECT, durations.STATUS)) == {
+        'HUNG': 'TIMEOUT', 'OK': 'COMPLETE'}
+
+
+def test_listing_same_project_times_out(monkeypatch):
+    # Waiting on a hung listing of the same project raises instead of
+    # blocking forever
+    monkeypatch.setattr(xnat_cache, 'LIST_TIMEOUT', 0.5)
+
+    hang = threading.Event()
+
+    @contextlib.contextmanager
+    def interface(**kwargs):
+        yield None
+
+    def session_label_list(xnat, project):
+        hang.wait(30)
+        return []
+
+    monkeypatch.setattr(xnat_cache.XnatUtils, 'InterfaceTemp', interface)
+    monkeypatch.setattr(utils, 'session_label_list', session_label_list)
+
+    sessions = xnat_cache.SessionCache()
+    thread = threading.Thread(target=sessions.session_labels, args=('PI',))
+    thread.start()
+
+    try:
+        time.sleep(0.1)
+        with pytest.raises(TimeoutError):
+            sessions.session_labels('PI')
+    finally:
+        hang.set()
+        thread.join()
+
+
+def test_more_hung_audits_than_workers(monkeypatch, tmp_path):
+    # Every worker hangs, the queued projects never start and should be
+    # cancelled when the run times out
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(audits, 'AUDIT_WORKERS', 2)
+    monkeypatch.setattr(audits, 'AUDIT_TIMEOUT', 0.5)
+    monkeypatch.setattr(audits, 'AUDIT_RUN_TIMEOUT', 1.5)
+    monkeypatch.setattr(audits, 'AUDIT_POLL', 0.1)
+
+    hang = threading.Event()
+    ran = []
+
+    def audit_one_project(p, snapshot, started, sessions=None):
+        started[p] = time.time()
+        ran.append(p)
+        if p.startswith('HUNG'):
+            hang.wait(30)
+
+        return [], 'COMPLETE'
+
+    monkeypatch.setattr(audits, 'audit_one_project', audit_one_project)
+
+    projects = ['HUNG1', 'HUNG2', 'HUNG3', 'OK']
+    try:
+        start = time.time()
+        results = audits.audit_projects(projects, None)
+        assert time.time() - start < 10
+    finally:
+        hang.set()
+
+    assert sorted(ran) == ['HUNG1', 'HUNG2']
+    for p in projects:
+        assert results[p][0]['type'] == 'ERROR'
+        assert 'timed out' in results[p][0]['description']
+
+    durations = audits.load_durations()
+    assert sorted(durations.PROJECT) == projects
+    assert set(durations.STATUS) == {'TIMEOUT'}
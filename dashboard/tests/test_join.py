@@ -0,0 +1,67 @@
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from stats.join import KeyIndex, share_categories
+
+
+def stats_frames(n, pieces):
+    # Synthetic data shaped like a stats refresh: n assessors in several
+    # stats redcaps, each joined to the XNAT sessions, then demographics and
+    # scores joined on subject and session type
+    rng = np.random.default_rng(0)
+    subjects = np.array(['{:05d}'.format(x) for x in range(n // 4)])
+    sesstypes = np.array(['Baseline', 'Week6', 'Week12', 'Week3'])
+    sessions = pd.DataFrame({
+        'SESSION': ['{:06d}'.format(x) for x in range(n)],
+        'SUBJECT': rng.choice(subjects, n),
+        'SESSTYPE': rng.choice(sesstypes, n),
+        'SITE': rng.choice(['A', 'B', 'C'], n)})
+    stats = pd.DataFrame({
+        'SESSION': sessions['SESSION'].sample(frac=1, random_state=0).values,
+        'VALUE': rng.random(n)})
+    size = (n // pieces) + 1
+    stats = [stats.iloc[i:i + size] for i in range(0, n, size)]
+    demog = pd.DataFrame({
+        'SUBJECT': subjects,
+        'AGE': rng.integers(20, 90, len(subjects))})
+    scores = sessions[['SUBJECT', 'SESSTYPE']].drop_duplicates()
+    scores = scores.sample(frac=0.5, random_state=0).copy()
+    scores['ma_tot'] = rng.integers(0, 60, len(scores))
+
+    return sessions, stats, demog, scores
+
+
+def test_keyindex_matches_merge(n=20000, pieces=10):
+    # KeyIndex joins give the same rows as merges on object keys, the
+    # timings are logged for comparing the two
+    sessions, stats, demog, scores = stats_frames(n, pieces)
+
+    start = time.time()
+    merged = [x.merge(sessions, on='SESSION', how='left') for x in stats]
+    merged = pd.concat(merged, ignore_index=True)
+    merged = merged.merge(demog, on='SUBJECT', how='left')
+    merged = merged.merge(scores, on=['SUBJECT', 'SESSTYPE'], how='outer')
+    logging.info(f'merge:{n} rows:{time.time() - start:.3f} secs')
+
+    start = time.time()
+    sessions = sessions.copy()
+    demog = demog.copy()
+    scores = scores.copy()
+    share_categories([sessions, demog, scores], 'SUBJECT')
+    share_categories([sessions, scores], 'SESSTYPE')
+    index = KeyIndex(sessions, ['SESSION'])
+    joined = [index.join(x) for x in stats]
+    joined = pd.concat(joined, ignore_index=True)
+    joined = KeyIndex(demog, ['SUBJECT']).join(joined)
+    joined = KeyIndex(scores, ['SUBJECT', 'SESSTYPE']).join(
+        joined, how='outer')
+    logging.info(f'keyindex:{n} rows:{time.time() - start:.3f} secs')
+
+    _cols = list(merged.columns)
+    _sort = ['SESSION', 'SUBJECT', 'SESSTYPE']
+    a = merged[_cols].astype(str).sort_values(_sort).reset_index(drop=True)
+    b = joined[_cols].astype(str).sort_values(_sort).reset_index(drop=True)
+    pd.testing.assert_frame_equal(a, b)
@@ -0,0 +1,17 @@
+from admin.snapshot import parse_choices
+
+
+def test_parse_choices():
+    choices = '1, T1 | 2, fMRI | -1, Missing |  | No comma'
+    assert parse_choices(choices) == {'1': 'T1', '2': 'fMRI', '_1': 'Missing'}
+
+
+def test_parse_choices_codes_like_redcap():
+    # Codes in export names are lowercase with anything other than letters
+    # and digits replaced by underscores
+    choices = 'T1-MPR, T1 | dti.64, DTI | rest 1, Rest | Flair/2, FLAIR'
+    assert parse_choices(choices) == {
+        't1_mpr': 'T1',
+        'dti_64': 'DTI',
+        'rest_1': 'Rest',
+        'flair_2': 'FLAIR'}
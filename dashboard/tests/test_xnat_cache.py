@@ -0,0 +1,40 @@
+import logging
+import time
+
+import pytest
+
+pytest.importorskip('dax')
+pytest.importorskip('redcap')
+
+import utils
+from admin.xnat_cache import SessionCache
+
+
+def test_sets_match_lists(n=10000, records=2000):
+    # Session lookups in the cache sets give the same answers as the lists
+    # they replaced, for an audit of a project with n sessions and the
+    # unmatched check of a PI project with n sessions
+    labels = ['{:06d}'.format(x) for x in range(n)]
+    vuiisids = ['{:06d}'.format(x) for x in range(0, n, 2)]
+    queries = ['{:06d}'.format(x * 7) for x in range(records)]
+    params = {'pimap': [{'pi': 'PI', 'main': ['MAIN'], 'ignore': []}]}
+
+    # Lists like the sessions used to be, each record checks the destination
+    # and source sessions
+    start = time.time()
+    found = [(x in vuiisids, x in labels) for x in queries]
+    unmatched = [x for x in labels if x not in vuiisids]
+    logging.info(f'lists:{n} sessions:{time.time() - start:.3f} secs')
+
+    cache = SessionCache()
+    cache._labels = {'PI': frozenset(labels)}
+    cache._vuiisids = {'MAIN': frozenset(vuiisids)}
+    start = time.time()
+    _dst = cache.session_vuiisids('MAIN')
+    _src = cache.session_labels('PI')
+    _found = [(x in _dst, x in _src) for x in queries]
+    _unmatched = utils.get_unmatched(params, cache)
+    logging.info(f'sets:{n} sessions:{time.time() - start:.3f} secs')
+
+    assert found == _found
+    assert sorted(['PI_' + x for x in unmatched]) == sorted(_unmatched)
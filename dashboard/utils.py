@@ -3,6 +3,7 @@ import os
 import pandas as pd
 import logging
 import json
+import tempfile
 
 from dax import XnatUtils
 
@@ -148,6 +149,21 @@ def save_data(df, filename):
     df.to_pickle(filename)
 
 
+def save_pickle(obj, filename):
+    # Write to a temp file in the same dir and then replace, so anyone
+    # reading the file never gets half of it
+    fd, tmpname = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    os.close(fd)
+
+    try:
+        pd.to_pickle(obj, tmpname)
+        os.replace(tmpname, filename)
+    except Exception:
+        os.remove(tmpname)
+        raise
+
+
 def match_repeat(mainrc, record_id, repeat_name, match_field, match_value):
 
     # Load potential matches
@@ -180,23 +196,24 @@ def session_vuiisid_list(xnat, projectid):
     return vuiisid_list
 
 
-def get_unmatched(params):
+def get_unmatched(params, sessions):
+    # sessions lists the session labels and vuiisids of XNAT projects,
+    # see admin.xnat_cache.SessionCache
     unmatched = []
 
-    with XnatUtils.InterfaceTemp(xnat_retries=0) as xnat:
-        for p in params['pimap']:
-            vuiisid_list = []
-            pi = p['pi']
-            main = p['main']
-            ignore = p['ignore']
-            label_list = session_label_list(xnat, pi)
-            label_list = [x for x in label_list if x not in ignore]
+    for p in params['pimap']:
+        pi = p['pi']
+        main = p['main']
+        ignore = set(p['ignore'])
 
-            for m in main:
-                vuiisid_list += session_vuiisid_list(xnat, m)
+        # Sets so each check is a lookup not a scan of the project
+        vuiisid_set = set()
+        for m in main:
+            vuiisid_set.update(sessions.session_vuiisids(m))
 
-            pi_unmatched = [x for x in label_list if x not in vuiisid_list]
+        label_set = sessions.session_labels(pi)
+        pi_unmatched = label_set.difference(ignore, vuiisid_set)
 
-            unmatched += [(pi+'_'+x) for x in pi_unmatched]
+        unmatched += [(pi+'_'+x) for x in sorted(pi_unmatched)]
 
     return unmatched
\ No newline at end of file